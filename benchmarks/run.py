@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Runs the pkggen benchmarks against a local fake server and writes the results as JSON. Comparing against a
+previous result file reports every benchmark that got slower than the threshold, for example:
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PKGGEN = os.path.join(ROOT, "src", "pkggen", "pkggen")
+GENERATORS = os.path.join(ROOT, "generators")
+
+RESULTS_VERSION = 1
+DEFAULT_THRESHOLD = 0.2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "pkggen"))
+sys.path.insert(0, os.path.join(GENERATORS, "generation"))
+
+from server import FakeServer
+
+def get_env(workdir, server):
+    env = os.environ.copy()
+    env.update({
+        "XDG_CONFIG_HOME": os.path.join(workdir, "config"),
+        "XDG_CACHE_HOME": os.path.join(workdir, "cache"),
+        "PKGGEN_RUN_PATH": os.path.join(workdir, "run"),
+        "PKGGEN_GENERATORS_PATH": GENERATORS,
+        "PKGGEN_REPOLOGY_API": f"{server.url}/api/v1/project",
+    })
+    return env
+
+def write_config(workdir, server, packages, size):
+    lines = [
+        "checksums: [ \"sha2-256\", \"sha2-512\" ]",
+        "github-packages:",
+        "  generator: github",
+        "  packages:",
+    ]
+    for i in range(packages // 2):
+        query = [ "releases", "tags", "commits" ][i % 3]
+        lines.append(f"    - name: github-{i}")
+        lines.append(f"      github: {{ user: bench, repo: project{i}-{size}, query: {query}, api-url: \"{server.url}\", archive-url: \"{server.url}\" }}")
+
+    lines += [
+        "url-packages:",
+        "  generator: url",
+        "  packages:",
+    ]
+    for i in range(packages - packages // 2):
+        lines.append(f"    - name: url-{i}")
+        lines.append(f"      url-generator: {{ url: \"{server.url}/files/{size}/url-{i}.tar.gz\", version: \"1.0\" }}")
+
+    os.makedirs(os.path.join(workdir, "run"), exist_ok=True)
+    with open(os.path.join(workdir, "run", "pkggen.yaml"), "w") as stream:
+        stream.write("\n".join(lines) + "\n")
+
+def run_generate(workdir, env, args):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [ sys.executable, PKGGEN, "generate", "-o", os.path.join(workdir, "out") ] + args,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"pkggen generate failed:\n{result.stderr}")
+    return elapsed
+
+def write_secrets(workdir, secrets):
+    os.makedirs(os.path.join(workdir, "config", "pkggen"), exist_ok=True)
+    with open(os.path.join(workdir, "config", "pkggen", "secrets.yaml"), "w") as stream:
+        stream.write("".join(f"{key}: \"{value}\"\n" for key, value in secrets.items()))
+
+def bench_generate(server, results, package_counts, sizes, workers, batched=False):
+    """
+    Generates packages from the fake server. Batched runs have a GitHub API key, with which the GitHub
+    generator resolves its packages through the fake GraphQL endpoint instead of the REST API.
+    """
+    for packages in package_counts:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as workdir:
+                env = get_env(workdir, server)
+                write_config(workdir, server, packages, size)
+                if batched:
+                    write_secrets(workdir, { "github_key": "benchmark" })
+
+                # The first run downloads everything, the second one only revalidates the cached artifacts
+                cold = run_generate(workdir, env, [ "-w", str(workers) ])
+                warm = run_generate(workdir, env, [ "-w", str(workers) ])
+
+            name = f"{'generate-batched' if batched else 'generate'}/{packages}-packages/{size // 1024}KiB"
+            results[f"{name}/cold"] = { "value": packages / cold, "unit": "packages/s", "higher-is-better": True }
+            results[f"{name}/cold-throughput"] = { "value": packages * size / cold / 1024 ** 2, "unit": "MiB/s", "higher-is-better": True }
+            results[f"{name}/warm"] = { "value": packages / warm, "unit": "packages/s", "higher-is-better": True }
+
+def bench_hashes(results, size):
+    import lib
+
+    data = os.urandom(size)
+    for keys in [ [ "sha2-256" ], None ]:
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            if keys == None:
+                lib.calculate_hashes({}, data)
+            else:
+                hasher = lib.MultiHasher(keys)
+                hasher.update(data)
+                hasher.hexdigests()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best == None else min(best, elapsed)
+
+        name = "hashes/all" if keys == None else f"hashes/{keys[0]}"
+        results[name] = { "value": size / best / 1024 ** 2, "unit": "MiB/s", "higher-is-better": True }
+
+def bench_downloads(server, results, size):
+    import lib
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+        for segmented in [ False, True ]:
+            # Lowering the threshold decides between a single stream and concurrent ranges for the same file
+            lib.SEGMENTED_DOWNLOAD_THRESHOLD = 0 if segmented else size + 1
+            url = f"{server.url}/files/{size}/{'segmented' if segmented else 'streamed'}.tar.gz"
+            start = time.perf_counter()
+            lib.fetch_artifact(url, keys=[ "sha2-256" ])
+            elapsed = time.perf_counter() - start
+
+            name = "download/segmented" if segmented else "download/streamed"
+            results[name] = { "value": size / elapsed / 1024 ** 2, "unit": "MiB/s", "higher-is-better": True }
+
+def bench_spawn(server, results, calls):
+    from workers import GeneratorWorker
+
+    generator = os.path.join(GENERATORS, "generation", "url.py")
+    package = json.dumps({ "name": "spawn", "url-generator": { "url": f"{server.url}/files/1024/spawn.tar.gz", "version": "1.0" } })
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = get_env(workdir, server)
+
+        # Probing needs no requests, so this measures the cost of getting a package to a generator
+        start = time.perf_counter()
+        for _ in range(calls):
+            subprocess.run([ sys.executable, generator, "--probe" ], input=package, text=True, capture_output=True, env=env, check=True)
+        spawned = (time.perf_counter() - start) / calls
+
+        worker = GeneratorWorker(generator, env)
+        worker.run(package, "probe")
+        start = time.perf_counter()
+        for _ in range(calls):
+            worker.run(package, "probe")
+        persistent = (time.perf_counter() - start) / calls
+        worker.stop()
+
+    results["spawn/process-per-package"] = { "value": spawned * 1000, "unit": "ms", "higher-is-better": False }
+    results["spawn/persistent-worker"] = { "value": persistent * 1000, "unit": "ms", "higher-is-better": False }
+
+def bench_repology(server, results, entries):
+    with tempfile.TemporaryDirectory() as workdir:
+        # The API URL is read when the module is imported
+        os.environ.update(get_env(workdir, server))
+        import utils
+        from utilities import repology
+        from utilities.repology_database import RepologyDatabase, import_dump
+
+        server.repology_entries = entries
+        index = repology.DistributionIndex(utils.load_distributions())
+        status, data = repology.fetch_project("bench", 0)
+
+        for include_outdated in [ False, True ]:
+            best = None
+            for _ in range(5):
+                start = time.perf_counter()
+                repology.match_project("bench", data, index, include_outdated)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best == None else min(best, elapsed)
+            name = "repology/match-outdated" if include_outdated else "repology/match"
+            results[name] = { "value": entries / best, "unit": "entries/s", "higher-is-better": True }
+
+        dump = os.path.join(workdir, "dump.json")
+        with open(dump, "w") as stream:
+            json.dump({ f"project{i}": data[:10] for i in range(5000) }, stream)
+        start = time.perf_counter()
+        import_dump(dump, os.path.join(workdir, "repology.sqlite"))
+        results["repology/import"] = { "value": 5000 / (time.perf_counter() - start), "unit": "projects/s", "higher-is-better": True }
+
+        database = RepologyDatabase(os.path.join(workdir, "repology.sqlite"))
+        start = time.perf_counter()
+        for i in range(1000):
+            database.lookup(f"project{i * 5}")
+        results["repology/offline-lookup"] = { "value": (time.perf_counter() - start) / 1000 * 1000, "unit": "ms", "higher-is-better": False }
+        database.close()
+
+def get_commit():
+    try:
+        return subprocess.run([ "git", "rev-parse", "HEAD" ], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """
+    Prints every benchmark next to its baseline and returns the names of the ones that regressed
+    """
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name.ljust(width)}  {result['value']:12.2f} {result['unit']}  (new)")
+            continue
+
+        old = baseline[name]["value"]
+        change = (result["value"] - old) / old if old != 0 else 0.0
+        worse = -change if result["higher-is-better"] else change
+        marker = "  REGRESSION" if worse > threshold else ""
+        print(f"{name.ljust(width)}  {result['value']:12.2f} {result['unit']}  ({change:+.1%} vs {old:.2f}){marker}")
+        if worse > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pkggen against a local fake GitHub, file and repology server")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("-c", "--compare", help="Compare the results against a previous results file and fail on regressions")
+    parser.add_argument("-t", "--threshold", help="Relative slowdown that counts as a regression", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("-w", "--workers", help="Number of persistent generator workers used by the generate benchmarks", type=int, default=4)
+    parser.add_argument("--quick", help="Run a smaller set of benchmarks", action="store_true")
+    args = parser.parse_args()
+
+    server = FakeServer().start()
+    results = {}
+
+    if args.quick:
+        bench_generate(server, results, [ 8 ], [ 64 * 1024 ], args.workers)
+        bench_generate(server, results, [ 8 ], [ 64 * 1024 ], args.workers, batched=True)
+        bench_hashes(results, 16 * 1024 ** 2)
+        bench_downloads(server, results, 32 * 1024 ** 2)
+        bench_spawn(server, results, 5)
+        bench_repology(server, results, 2000)
+    else:
+        bench_generate(server, results, [ 8, 32 ], [ 64 * 1024, 4 * 1024 ** 2 ], args.workers)
+        bench_generate(server, results, [ 32 ], [ 64 * 1024 ], args.workers, batched=True)
+        bench_hashes(results, 64 * 1024 ** 2)
+        bench_downloads(server, results, 256 * 1024 ** 2)
+        bench_spawn(server, results, 20)
+        bench_repology(server, results, 20000)
+
+    output = {
+        "version": RESULTS_VERSION,
+        "created": time.time(),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "benchmarks": results,
+    }
+
+    regressions = []
+    if args.compare != None:
+        with open(args.compare, "r") as stream:
+            regressions = compare(results, json.load(stream)["benchmarks"], args.threshold)
+    else:
+        for name, result in results.items():
+            print(f"{name}: {result['value']:.2f} {result['unit']}")
+
+    if args.output != None:
+        with open(args.output, "w") as stream:
+            json.dump(output, stream, indent=4)
+            stream.write("\n")
+
+    if len(regressions) > 0:
+        print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for GitHub, plain file hosts and repology that serves synthetic data for benchmarks:
+
+    /repos/{user}/{repo}                          Repository metadata
+    /repos/{user}/{repo}/releases                 Paged releases
+    /repos/{user}/{repo}/releases/latest          The newest release
+    /repos/{user}/{repo}/releases/tags/{tag}      A release by tag
+    /repos/{user}/{repo}/tags                     Paged tags
+    /repos/{user}/{repo}/git/ref/tags/{tag}       A tag reference
+    /repos/{user}/{repo}/commits[/{sha}]          Commits
+    /repos/{user}/{repo}/tarball/{ref}            Release and tag tarballs
+    /{user}/{repo}/archive/{sha}.tar.gz           Commit archives
+    /files/{size}/{name}                          Plain files for the URL generator
+    /api/v1/project/{name}                        repology projects
+    /graphql                                      Batched repository queries of the GitHub generator (POST)
+
+Repository names end with the size of their artifacts in bytes, for example "project-1048576". Artifacts
+carry an ETag, answer conditional requests with 304 Not Modified and support single byte range requests.
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+RELEASES = 250
+COMMIT_SHA = "0123456789abcdef0123456789abcdef01234567"
+CHUNK_SIZE = 1024 * 64
+CHUNK = bytes(range(256)) * (CHUNK_SIZE // 256)
+
+REPOLOGY_REPOS = [ "arch", "fedora_rawhide", "fedora_42", "fedora_38", "opensuse_tumbleweed", "gentoo", "debian_12", "aur", "pclinuxos" ]
+
+def get_artifact_size(repo):
+    match = re.search(r"-(\d+)$", repo)
+    return int(match.group(1)) if match != None else CHUNK_SIZE
+
+def get_release(base, number):
+    tag = f"v1.{number}.0"
+    return {
+        "name": tag,
+        "tag_name": tag,
+        "draft": False,
+        "prerelease": False,
+        "tarball_url": f"{base}/tarball/{tag}",
+        "assets": [],
+    }
+
+def get_repology_project(name, entries):
+    return [
+        {
+            "repo": REPOLOGY_REPOS[i % len(REPOLOGY_REPOS)],
+            "srcname": name if i % 3 != 0 else f"{name}-extra",
+            "binname": name,
+            "visiblename": name,
+            "version": f"{i % 17}.{i % 5}",
+            "status": "newest" if i % 4 == 0 else "outdated",
+            "summary": f"Synthetic entry {i}",
+        }
+        for i in range(entries)
+    ]
+
+def get_graphql_repository(host, user, repo, selection):
+    """
+    Answers a "repository" selection of a GraphQL query with the fields the GitHub generator asks for. Like
+    on GitHub, releases are ordered by date and tags alphabetically.
+    """
+    base = f"{host}/repos/{user}/{repo}"
+    node = { "description": f"Synthetic repository {repo}", "homepageUrl": f"https://example.com/{repo}", "licenseInfo": { "spdxId": "MIT" } }
+    if "defaultBranchRef" in selection:
+        node["defaultBranchRef"] = { "target": { "oid": COMMIT_SHA, "committedDate": "2025-01-01T00:00:00Z" } }
+    if "releases(" in selection:
+        node["releases"] = { "nodes": [
+            { "name": release["name"], "tagName": release["tag_name"], "isDraft": False, "isPrerelease": False, "releaseAssets": { "nodes": [] } }
+            for release in (get_release(base, number) for number in range(RELEASES, max(RELEASES - 100, 0), -1))
+        ] }
+    if "refs(" in selection:
+        node["refs"] = { "nodes": [ { "name": name } for name in sorted(f"v1.{number}.0" for number in range(1, RELEASES + 1))[:100] ] }
+    return node
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_artifact(self, size):
+        etag = f"\"{size}-{self.path}\""
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match != None and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        # The content repeats every 256 bytes, so any range can be served from the same chunk
+        offset = start
+        while offset <= end:
+            chunk = CHUNK[offset % 256:][:min(end + 1 - offset, CHUNK_SIZE - 256)]
+            self.wfile.write(chunk)
+            offset += len(chunk)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        host = f"http://{self.headers.get('Host')}"
+
+        match = re.fullmatch(r"/files/(\d+)/[^/]+", url.path)
+        if match != None:
+            return self.send_artifact(int(match.group(1)))
+
+        match = re.fullmatch(r"/api/v1/project/([^/]+)", url.path)
+        if match != None:
+            return self.send_json(get_repology_project(match.group(1), int(query.get("entries", self.server.repology_entries))))
+
+        match = re.fullmatch(r"/[^/]+/([^/]+)/archive/[0-9a-f]+\.tar\.gz", url.path)
+        if match != None:
+            return self.send_artifact(get_artifact_size(match.group(1)))
+
+        match = re.fullmatch(r"/repos/([^/]+)/([^/]+)(/.*)?", url.path)
+        if match == None:
+            return self.send_json({ "message": "Not Found" }, 404)
+
+        user, repo, rest = match.group(1), match.group(2), match.group(3) or ""
+        base = f"{host}/repos/{user}/{repo}"
+
+        if rest == "":
+            return self.send_json({ "description": f"Synthetic repository {repo}", "homepage": f"https://example.com/{repo}", "license": { "spdx_id": "MIT" } })
+        if rest.startswith("/tarball/"):
+            return self.send_artifact(get_artifact_size(repo))
+        if rest == "/releases/latest":
+            return self.send_json(get_release(base, RELEASES))
+
+        match = re.fullmatch(r"/releases/tags/v1\.(\d+)\.0", rest)
+        if match != None and 1 <= int(match.group(1)) <= RELEASES:
+            return self.send_json(get_release(base, int(match.group(1))))
+        match = re.fullmatch(r"/git/ref/tags/v1\.(\d+)\.0", rest)
+        if match != None and 1 <= int(match.group(1)) <= RELEASES:
+            return self.send_json({ "ref": f"refs/tags/v1.{match.group(1)}.0" })
+
+        if rest == "/releases" or rest == "/tags":
+            page = int(query.get("page", 1))
+            per_page = int(query.get("per_page", 30))
+            numbers = range(RELEASES - (page - 1) * per_page, max(RELEASES - page * per_page, 0), -1)
+            if rest == "/releases":
+                return self.send_json([ get_release(base, number) for number in numbers ])
+            return self.send_json([ { "name": f"v1.{number}.0", "tarball_url": f"{base}/tarball/refs/tags/v1.{number}.0" } for number in numbers ])
+
+        if rest == "/commits" or rest.startswith("/commits/"):
+            commit = { "sha": COMMIT_SHA, "commit": { "committer": { "date": "2025-01-01T00:00:00Z" } } }
+            return self.send_json([ commit ] if rest == "/commits" else commit)
+
+        self.send_json({ "message": "Not Found" }, 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path != "/graphql":
+            return self.send_json({ "message": "Not Found" }, 404)
+        if not self.headers.get("Authorization"):
+            return self.send_json({ "message": "This endpoint requires you to be authenticated." }, 401)
+
+        request = json.loads(body)
+        variables = request.get("variables") or {}
+        host = f"http://{self.headers.get('Host')}"
+
+        data = {}
+        selections = re.split(r"(r\d+): repository\(owner: \$(owner\d+), name: \$(name\d+)\)", request.get("query", ""))
+        for alias, owner, name, selection in zip(selections[1::4], selections[2::4], selections[3::4], selections[4::4]):
+            data[alias] = get_graphql_repository(host, variables[owner], variables[name], selection)
+        self.send_json({ "data": data })
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, repology_entries=1000):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.repology_entries = repology_entries
+
+    def handle_error(self, request, client_address):
+        # Clients close connections before reading the whole body on purpose, for example when they stop
+        # a download that they found to be cached
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic GitHub, file and repology responses for benchmarks")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("--repology-entries", help="Number of entries in every repology project", type=int, default=1000)
+    args = parser.parse_args()
+
+    server = FakeServer(args.port, args.repology_entries)
+    print(f"Serving on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Checks that the pkggen CLI starts quickly. Every command is run with "python -X importtime", and the time
+spent importing modules beyond what the interpreter imports at startup must stay within the budget. Commands
+that don't generate or query anything must not import any of the heavy dependencies at all. The modules that
+subcommands import lazily are measured on their own against budgets of their own, which can be scaled for
+slower machines:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --budget 50 --module-scale 2
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, "src", "pkggen")
+PKGGEN = os.path.join(SOURCE, "pkggen")
+GENERATORS = os.path.join(ROOT, "generators")
+
+DEFAULT_BUDGET = 30.0
+RUNS = 5
+
+COMMANDS = [
+    [ "--help" ],
+    [ "version" ],
+    [ "test" ],
+    [ "deploy" ],
+    [ "generate", "--help" ],
+    [ "repology", "--help" ],
+    [ "repology-import", "--help" ],
+    [ "watch", "--help" ],
+    [ "serve", "--help" ],
+]
+
+# Import time budgets in milliseconds of the modules that subcommands import lazily, which are expected to
+# pull in the heavy dependencies
+MODULE_BUDGETS = {
+    "generate": 350.0,
+    "watch": 350.0,
+    "serve": 350.0,
+    "utilities.repology": 250.0,
+    "utilities.repology_database": 60.0,
+}
+
+# Only the subcommands that need these may import them
+HEAVY_MODULES = [ "yaml", "requests", "jinja2", "tqdm", "packaging", "concurrent.futures", "multiprocessing", "sqlite3" ]
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def get_imports(args):
+    """
+    Returns the top-level imports of a run as a dictionary of module names to their cumulative import time
+    in microseconds, together with every module that was imported
+    """
+    # Modules that share lib.py with the generators need to find it
+    env = dict(os.environ, PKGGEN_GENERATORS_PATH=os.getenv("PKGGEN_GENERATORS_PATH", GENERATORS))
+    result = subprocess.run([ sys.executable, "-X", "importtime" ] + args, capture_output=True, text=True, env=env)
+    top_level = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match == None:
+            continue
+        modules.add(match.group(4))
+        if len(match.group(3)) == 1:
+            top_level[match.group(4)] = int(match.group(2))
+    return top_level, modules
+
+def measure(args, baseline):
+    # The fastest of several runs is the least affected by other load on the machine
+    best = None
+    modules = set()
+    for _ in range(RUNS):
+        top_level, modules = get_imports(args)
+        elapsed = sum(time for name, time in top_level.items() if name not in baseline) / 1000
+        best = elapsed if best == None else min(best, elapsed)
+    return best, modules - baseline
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of every pkggen command against a budget")
+    parser.add_argument("-b", "--budget", help="Maximum import time of a command in milliseconds", type=float, default=DEFAULT_BUDGET)
+    parser.add_argument("-m", "--module-scale", help="Multiply the import time budgets of subcommand modules by this", type=float, default=1.0)
+    args = parser.parse_args()
+
+    # Modules imported by the interpreter itself, for example by site, aren't pkggen's to pay for
+    _, baseline = get_imports([ "-c", "pass" ])
+
+    failed = []
+    width = max([ len(f"pkggen {' '.join(command)}") for command in COMMANDS ] + [ len(f"import {module}") for module in MODULE_BUDGETS ])
+    for command in COMMANDS:
+        elapsed, modules = measure([ PKGGEN ] + command, baseline)
+        heavy = sorted(module for module in HEAVY_MODULES if module in modules)
+
+        problems = []
+        if elapsed > args.budget:
+            problems.append(f"over the {args.budget:.0f}ms budget")
+        if len(heavy) > 0:
+            problems.append(f"imports {', '.join(heavy)}")
+        print(f"{('pkggen ' + ' '.join(command)).ljust(width)}  {elapsed:8.2f}ms  {'; '.join(problems) if problems else 'ok'}")
+        if len(problems) > 0:
+            failed.append(" ".join(command))
+
+    for module, budget in MODULE_BUDGETS.items():
+        budget *= args.module_scale
+        elapsed, _ = measure([ "-c", f"import sys; sys.path.insert(0, {SOURCE!r}); import {module}" ], baseline)
+        problem = f"over the {budget:.0f}ms budget" if elapsed > budget else "ok"
+        print(f"{('import ' + module).ljust(width)}  {elapsed:8.2f}ms  {problem}")
+        if elapsed > budget:
+            failed.append(f"import {module}")
+
+    if len(failed) > 0:
+        print(f"{len(failed)} commands or modules are too slow to start: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Replays sample GitHub webhook deliveries against "pkggen serve". Every payload is signed with the
+webhook_secret from secrets.yaml like GitHub does, and sent with the event named after its file:
+
+    python benchmarks/webhooks/replay.py release.json
+    python benchmarks/webhooks/replay.py --repository user/repo --times 3 release.json create.json push.json
+
+The samples target the repositories of the packages written by benchmarks/run.py: a release of
+bench/project0-65536, a new tag of bench/project1-65536 and a push to the default branch of
+bench/project2-65536.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+WEBHOOKS = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_URL = "http://127.0.0.1:8080/webhook"
+
+sys.path.insert(0, os.path.join(ROOT, "src", "pkggen"))
+
+def load_payload(path, repository=None):
+    if not os.path.exists(path):
+        path = os.path.join(WEBHOOKS, path)
+    with open(path, "r") as stream:
+        payload = json.load(stream)
+    if repository != None:
+        owner, name = repository.split("/", 1)
+        payload["repository"].update({ "full_name": repository, "name": name, "html_url": f"https://github.com/{repository}" })
+        payload["repository"]["owner"]["login"] = owner
+    return os.path.splitext(os.path.basename(path))[0], json.dumps(payload).encode("utf-8")
+
+def deliver(url, secret, event, body):
+    request = urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "User-Agent": "GitHub-Hookshot/pkggen-replay",
+        "X-GitHub-Event": event,
+        "X-GitHub-Delivery": str(uuid.uuid4()),
+        "X-Hub-Signature-256": "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest(),
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode("utf-8")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay sample GitHub webhook deliveries against pkggen serve")
+    parser.add_argument("payloads", help="Payload files, relative to this directory unless they exist as given. The file name is the event name", nargs="+")
+    parser.add_argument("-u", "--url", help="The URL pkggen serve listens on", default=DEFAULT_URL)
+    parser.add_argument("-s", "--secret", help="The webhook secret, defaults to the webhook_secret from secrets.yaml")
+    parser.add_argument("-r", "--repository", help="Send the payloads for this \"owner/repo\" instead")
+    parser.add_argument("-n", "--times", help="Send every payload this many times", type=int, default=1)
+    parser.add_argument("-i", "--interval", help="Seconds to wait between deliveries", type=float, default=0.0)
+    args = parser.parse_args()
+
+    secret = args.secret
+    if secret == None:
+        import utils
+        secret = utils.load_secrets().get("webhook_secret")
+        if not secret:
+            print(f"No webhook_secret found in {utils.create_secrets_file()}! Pass one with --secret.", file=sys.stderr)
+            sys.exit(1)
+
+    deliveries = [ load_payload(path, args.repository) for path in args.payloads ] * args.times
+    failed = 0
+    for index, (event, body) in enumerate(deliveries):
+        if index > 0 and args.interval > 0:
+            time.sleep(args.interval)
+        status, response = deliver(args.url, str(secret), event, body)
+        print(f"{event}: {status} {response}")
+        failed += status >= 300
+
+    if failed > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import lib
-import requests
 import re
+import sys
 import json
 from datetime import datetime
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 
 """
@@ -57,7 +59,17 @@ Input:
 
             // An optional field for enterprise users which host their own GitHub enterprise
             // instance under a different domain. Defaults to api.github.com
-            "api-domain": "api.github.com"
+            "api-domain": "api.github.com",
+
+            // Optional: The base URL commit archives are downloaded from. Defaults to https://{domain}
+            "archive-url": "https://github.com",
+
+            // Optional: The base URL of the REST API. Defaults to https://{api-domain}
+            "api-url": "https://api.github.com",
+
+            // Optional: The URL of the GraphQL API used to batch queries for many repositories.
+            // Defaults to {api-url}/graphql
+            "graphql-url": "https://api.github.com/graphql"
         }
     }
     
@@ -140,6 +152,9 @@ class GitHubData:
 
         self.domain = "github.com"
         self.api_domain = "api.github.com"
+        self.archive_url = "https://github.com"
+        self.api_url = "https://api.github.com"
+        self.graphql_url = "https://api.github.com/graphql"
 
     def __init__(self, data, pkgname):
         def sanitise_query(query):
@@ -176,6 +191,9 @@ class GitHubData:
 
         self.domain = data["domain"] if "domain" in data else "github.com"
         self.api_domain = data["api-domain"] if "api-domain" in data else "api.github.com"
+        self.archive_url = data["archive-url"] if "archive-url" in data else f"https://{self.domain}"
+        self.api_url = data["api-url"] if "api-url" in data else f"https://{self.api_domain}"
+        self.graphql_url = data["graphql-url"] if "graphql-url" in data else f"{self.api_url}/graphql"
 
         secrets = lib.load_secrets()
         self.github_key = secrets["github_key"] if "github_key" in secrets else None
@@ -196,79 +214,61 @@ def get_api_headers(key):
 def generate_artifact_data(tarball_urls, user, repo):
     result = []
     for tarball_url in tarball_urls:
-        tarball_response = requests.get(tarball_url, timeout=10, stream=True)
-        size = int(tarball_response.headers.get("content-length", 0))
-    
-        if tarball_response.status_code == 200:
-            buf = lib.download_to_buffer(tarball_response, size, tarball_url)
-            result.append({
-                "url": tarball_url,
-                "checksums": {}
-            })
-
-            lib.calculate_hashes(result[-1]["checksums"], buf.getvalue())
-            if size != 0:
-                result[-1]["size"] = size
-        else:
-            raise lib.TinyError(f"Invalid git commit hash for GitHub repository {user}/{repo}!")
-
+        with lib.span("artifact", url=tarball_url):
+            result.append(lib.fetch_artifact(tarball_url, error=f"Invalid git commit hash for GitHub repository {user}/{repo}!"))
     return result
 
-def get_exports(github):
+def parse_exports(data):
     result = {}
-    response = requests.get(f"https://{github.api_domain}/repos/{github.user}/{github.repo}", headers=get_api_headers(github.github_key))
-    if response.status_code == 200:
-        data = response.json()
 
-        description = data["description"] if "description" in data and data["description"] else None
-        if description != None:
-            result["description"] = description
+    description = data["description"] if "description" in data and data["description"] else None
+    if description != None:
+        result["description"] = description
 
-        license_str = data["license"]["spdx_id"] if "license" in data and data["license"] != None and "spdx_id" in data["license"] else None
-        if license_str != None:
-            result["license"] = license_str
+    license_str = data["license"]["spdx_id"] if "license" in data and data["license"] != None and "spdx_id" in data["license"] else None
+    if license_str != None:
+        result["license"] = license_str
 
-        homepage = data["homepage"] if "homepage" in data and data["homepage"] != None and data["homepage"] != "" else None
-        if homepage != None:
-            result["homepage"] = homepage
+    homepage = data["homepage"] if "homepage" in data and data["homepage"] != None and data["homepage"] != "" else None
+    if homepage != None:
+        result["homepage"] = homepage
 
-        return result
+    return result
 
+def get_exports(github, prefetched=None):
+    if prefetched != None and "repository" in prefetched:
+        return parse_exports(prefetched["repository"])
 
-def generate_commit(github):
-    result = {}
+    with lib.span("exports"):
+        response = lib.cached_get(f"{github.api_url}/repos/{github.user}/{github.repo}", headers=get_api_headers(github.github_key), timeout=10)
+    if response.status_code == 200:
+        return parse_exports(response.json())
+
+
+def resolve_commit(github, prefetched=None):
     api_headers = get_api_headers(github.github_key)
-    
+
     if github.version != None:
-        response = requests.get(f"https://{github.api_domain}/repos/{github.user}/{github.repo}/commits/{github.version}", headers=api_headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-
-            result["version"] = transform_date(data["commit"]["committer"]["date"])
-            result["tarball-urls"] = generate_artifact_data(
-                [
-                    f"https://{github.domain}/{github.user}/{github.repo}/archive/{data['sha']}.tar.gz"
-                ],
-                github.user,
-                github.repo
-            )
-        else:
+        response = lib.cached_get(f"{github.api_url}/repos/{github.user}/{github.repo}/commits/{quote(github.version, safe='')}", headers=api_headers, timeout=10)
+        if response.status_code != 200:
             raise lib.TinyError(f"Invalid git commit hash for GitHub repository {github.user}/{github.repo}!")
+        data = response.json()
+    elif prefetched != None and "commits" in prefetched:
+        data = prefetched["commits"][0]
     else:
-        response = requests.get(f"https://{github.api_domain}/repos/{github.user}/{github.repo}/commits", headers=api_headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()[0]
-            result["version"] = transform_date(data["commit"]["committer"]["date"])
-            result["tarball-urls"] = generate_artifact_data(
-                [
-                    f"https://{github.domain}/{github.user}/{github.repo}/archive/{data['sha']}.tar.gz"
-                ],
-                github.user,
-                github.repo
-            )
-        else:
+        response = lib.cached_get(f"{github.api_url}/repos/{github.user}/{github.repo}/commits?per_page=1", headers=api_headers, timeout=10)
+        if response.status_code != 200:
             raise lib.TinyError(f"Invalid git commit hash for GitHub repository {github.user}/{github.repo}!")
-    result["exports"] = get_exports(github)
+        data = response.json()[0]
+
+    return transform_date(data["commit"]["committer"]["date"]), [ f"{github.archive_url}/{github.user}/{github.repo}/archive/{data['sha']}.tar.gz" ]
+
+def generate_commit(github, prefetched=None):
+    result = {}
+    with lib.span("resolve", query=github.query):
+        result["version"], urls = resolve_commit(github, prefetched)
+    result["tarball-urls"] = generate_artifact_data(urls, github.user, github.repo)
+    result["exports"] = get_exports(github, prefetched)
     return result
 
 def apply_version_transforms(transforms, version):
@@ -280,137 +280,287 @@ def apply_version_transforms(transforms, version):
                 raise lib.TinyError(f"Elements of the transforms array must be arrays with 2 elements!")
     return version
 
-def generate_release_or_tag(pkgname, github):
-    api_headers = get_api_headers(github.github_key)
-    page = 1
-    result = {}
+def is_matching_release_or_tag(obj, github, regex_filter):
+    if github.version != None:
+        return github.version == obj["name"]
+
+    if github.query == "releases":
+        if (not github.include_drafts and obj["draft"]) or (not github.include_pre_releases and obj["prerelease"]):
+            return False
+    return regex_filter == None or regex_filter.search(obj["name"])
+
+def find_release_or_tag(data, github, regex_filter):
+    for obj in data:
+        if is_matching_release_or_tag(obj, github, regex_filter):
+            return obj
+    return None
 
-    while True:
-        response = requests.get(f"https://{github.api_domain}/repos/{github.user}/{github.repo}/{github.query}?page={page}&per_page=100", headers=api_headers, timeout=10)
+def lookup_release_or_tag(github, api_headers):
+    """
+    Fetches the release/tag directly when the query allows it, instead of paging through every release/tag
+    """
+    base = f"{github.api_url}/repos/{github.user}/{github.repo}"
+
+    if github.version != None:
+        # Versions are user-supplied and may contain characters that would change the requested resource
+        version = quote(github.version, safe="")
+        if github.query == "releases":
+            response = lib.cached_get(f"{base}/releases/tags/{version}", headers=api_headers, timeout=10)
+            # Pinned versions match release names, which are usually but not always the tag name
+            if response.status_code == 200 and response.json()["name"] == github.version:
+                return response.json()
+        elif github.query == "tags":
+            response = lib.cached_get(f"{base}/git/ref/tags/{version}", headers=api_headers, timeout=10)
+            if response.status_code == 200:
+                return { "name": github.version, "tarball_url": f"{base}/tarball/refs/tags/{quote(github.version, safe='/')}" }
+    elif github.select == None and github.query == "releases" and not github.include_drafts and not github.include_pre_releases:
+        response = lib.cached_get(f"{base}/releases/latest", headers=api_headers, timeout=10)
         if response.status_code == 200:
-            data = response.json()
-            if len(data) == 0:
-                raise lib.TinyError(f"Unable to find compatible version or the URL is invalid for GitHub repository {github.user}/{github.repo}")
-
-            obj = {}
-
-
-            if github.select != None:
-                if github.version != None:
-                    raise lib.TinyError(f"Cannot have both a \"version\" and a \"select\" key when generating a tag/release!")
-
-                regex_filter = re.compile(github.select)
-
-                def filter_fun(f, regex_filter, github):
-                    result = True
-                    if github.query == "releases":
-                        if (not github.include_drafts and f["draft"]) or (not github.include_pre_releases and f["prerelease"]):
-                            result = False
-                    return result and regex_filter.search(f["name"])
-
-                filtered = [f for f in data if filter_fun(f, regex_filter, github)]
-                
-                if len(filtered) > 0:
-                    obj = filtered[0]
-                    result["version"] = apply_version_transforms(github.transforms, obj["name"])
-                else:
-                    page += 1
-                    continue
-            else:
-                if github.version == None:
-                    if github.query == "releases":
-                        is_compatible = True
-                        for release in data:
-                            if (not github.include_drafts and release["draft"]) or (not github.include_pre_releases and release["prerelease"]):
-                                is_compatible = False
-                            else:
-                                is_compatible = True
-                            
-                            if is_compatible:
-                                obj = release
-                                break
-
-                        if is_compatible == False:
-                            page += 1
-                            continue
-                    else:
-                        obj = data[0]
-
-                    result["version"] = apply_version_transforms(github.transforms, obj["name"])
-                else:
-                    found_version = False
-                    for d in data:
-                        if github.version == d["name"]:
-                            found_version = True
-                            obj = d
-                            result["version"] = apply_version_transforms(github.transforms, d["name"])
-                            break
-
-                    if found_version == False:
-                        page += 1
-                        continue
-
-
-            if github.query == "tags":
-                result["tarball-urls"] = generate_artifact_data(
-                    [
-                        obj["tarball_url"]
-                    ],
-                    github.user,
-                    github.repo
-                )
-            elif github.query == "releases":
-                if github.artifacts == None:
-                    result["tarball-urls"] = generate_artifact_data(
-                        [
-                            obj["tarball_url"]
-                        ],
-                        github.user,
-                        github.repo
-                    )
-                else:
-                    new_artifacts = [ 
-                        artifact.format(
-                            pkgname=pkgname,
-                            version=result["version"],
-                            github_user = github.user,
-                            github_repo = github.repo
-                        )
-                        for artifact in github.artifacts
-                    ]
-                    urls = [ obj["tarball_url"] ]
-
-                    for asset in obj["assets"]:
-                        for artifact in new_artifacts:
-                            if artifact == asset["name"]:
-                                urls.append(asset["browser_download_url"])
-
-                    result["tarball-urls"] = generate_artifact_data(urls, github.user, github.repo)
-
-            result["exports"] = get_exports(github)
-            return result
-        else:
+            return response.json()
+
+    return None
+
+# Number of pages requested concurrently once a release/tag is not on the first page
+PAGE_PREFETCH = 4
+
+def scan_release_or_tag(github, api_headers, regex_filter):
+    def get_page(page):
+        with lib.span("page", query=github.query, page=page):
+            response = lib.cached_get(f"{github.api_url}/repos/{github.user}/{github.repo}/{github.query}?page={page}&per_page=100", headers=api_headers, timeout=10)
+        if response.status_code != 200:
             raise lib.TinyError(f"Unable to find compatible version or the URL is invalid for GitHub repository {github.user}/{github.repo}")
+        return response.json()
+
+    # Most queries match on the first page, so the following pages are only prefetched once it is clear
+    # that they are needed
+    pages = [ get_page(1) ]
+    page = 2
+    with ThreadPoolExecutor(max_workers=PAGE_PREFETCH) as executor:
+        while True:
+            for data in pages:
+                if len(data) == 0:
+                    raise lib.TinyError(f"Unable to find compatible version or the URL is invalid for GitHub repository {github.user}/{github.repo}")
+
+                obj = find_release_or_tag(data, github, regex_filter)
+                if obj != None:
+                    return obj
+
+                # A partial page is the last one
+                if len(data) < 100:
+                    raise lib.TinyError(f"Unable to find compatible version or the URL is invalid for GitHub repository {github.user}/{github.repo}")
+
+            pages = list(executor.map(get_page, range(page, page + PAGE_PREFETCH)))
+            page += PAGE_PREFETCH
+
+def resolve_release_or_tag(pkgname, github, prefetched=None):
+    api_headers = get_api_headers(github.github_key)
 
-        page += 1
-    
+    if github.select != None and github.version != None:
+        raise lib.TinyError(f"Cannot have both a \"version\" and a \"select\" key when generating a tag/release!")
+    regex_filter = re.compile(github.select) if github.select != None else None
+
+    # Batched GraphQL data only covers the newest releases/tags. Direct lookups are tried next and the
+    # REST API is paged through as a last resort
+    obj = None
+    if prefetched != None and github.query in prefetched:
+        obj = find_release_or_tag(prefetched[github.query], github, regex_filter)
+    if obj == None:
+        with lib.span("lookup", query=github.query):
+            obj = lookup_release_or_tag(github, api_headers)
+    if obj == None:
+        obj = scan_release_or_tag(github, api_headers, regex_filter)
+
+    version = apply_version_transforms(github.transforms, obj["name"])
+    urls = [ obj["tarball_url"] ]
+
+    if github.query == "releases" and github.artifacts != None:
+        new_artifacts = [ 
+            artifact.format(
+                pkgname=pkgname,
+                version=version,
+                github_user = github.user,
+                github_repo = github.repo
+            )
+            for artifact in github.artifacts
+        ]
 
-def generate(x):
+        for asset in obj["assets"]:
+            for artifact in new_artifacts:
+                if artifact == asset["name"]:
+                    urls.append(asset["browser_download_url"])
+
+    return version, urls
+
+def generate_release_or_tag(pkgname, github, prefetched=None):
+    result = {}
+    with lib.span("resolve", query=github.query):
+        result["version"], urls = resolve_release_or_tag(pkgname, github, prefetched)
+    result["tarball-urls"] = generate_artifact_data(urls, github.user, github.repo)
+    result["exports"] = get_exports(github, prefetched)
+    return result
+
+# Number of repositories resolved by a single GraphQL query
+GRAPHQL_BATCH_SIZE = 20
+
+def build_repository_query(index, queries):
+    fields = [
+        "description",
+        "homepageUrl",
+        "licenseInfo { spdxId }",
+    ]
+    if "commits" in queries:
+        fields.append("defaultBranchRef { target { ... on Commit { oid committedDate } } }")
+    if "releases" in queries:
+        fields.append(
+            "releases(first: 100, orderBy: { field: CREATED_AT, direction: DESC }) { "
+            "nodes { name tagName isDraft isPrerelease releaseAssets(first: 100) { nodes { name downloadUrl } } } }"
+        )
+    if "tags" in queries:
+        fields.append("refs(refPrefix: \"refs/tags/\", first: 100) { nodes { name } }")
+
+    return f"r{index}: repository(owner: $owner{index}, name: $name{index}) {{ {' '.join(fields)} }}"
+
+def convert_repository(github, node, queries):
+    """
+    Converts a GraphQL repository node into the shape of the REST API responses, so that prefetched data
+    goes through the same code paths as paged REST data
+    """
+    result = {
+        "repository": {
+            "description": node["description"],
+            "license": { "spdx_id": node["licenseInfo"]["spdxId"] } if node["licenseInfo"] != None else None,
+            "homepage": node["homepageUrl"],
+        }
+    }
+
+    base = f"{github.api_url}/repos/{github.user}/{github.repo}"
+    if "commits" in queries and node["defaultBranchRef"] != None and node["defaultBranchRef"]["target"] != None:
+        target = node["defaultBranchRef"]["target"]
+        result["commits"] = [ { "sha": target["oid"], "commit": { "committer": { "date": target["committedDate"] } } } ]
+    if "releases" in queries:
+        result["releases"] = [
+            {
+                "name": release["name"],
+                "tag_name": release["tagName"],
+                "draft": release["isDraft"],
+                "prerelease": release["isPrerelease"],
+                "tarball_url": f"{base}/tarball/{release['tagName']}",
+                "assets": [
+                    { "name": asset["name"], "browser_download_url": asset["downloadUrl"] }
+                    for asset in release["releaseAssets"]["nodes"]
+                ]
+            }
+            for release in node["releases"]["nodes"]
+        ]
+    if "tags" in queries:
+        result["tags"] = [
+            { "name": tag["name"], "tarball_url": f"{base}/tarball/refs/tags/{tag['name']}" }
+            for tag in node["refs"]["nodes"]
+        ]
+    return result
+
+def prepare(packages):
+    """
+    Resolves releases, tags, the latest commit and repository metadata for many packages at once, using
+    one GraphQL query per batch of repositories instead of several REST requests per package
+    """
+    repositories = {}
+    for package in packages:
+        if "name" not in package or "github" not in package:
+            continue
+        try:
+            github = GitHubData(package["github"], package["name"])
+        except lib.TinyError:
+            continue
+
+        # The REST tag listing is not ordered by date, so only pinned tags can be resolved from a
+        # GraphQL tag list without changing which tag gets picked
+        query = github.query
+        if query == "tags" and github.version == None:
+            query = None
+        elif query == "commits" and github.version != None:
+            query = None
+
+        key = (github.graphql_url, github.user, github.repo)
+        if key not in repositories:
+            repositories[key] = { "github": github, "queries": set(), "packages": [] }
+        if query != None:
+            repositories[key]["queries"].add(query)
+        repositories[key]["packages"].append((package["name"], query))
+
+    endpoints = {}
+    for entry in repositories.values():
+        endpoints.setdefault(entry["github"].graphql_url, []).append(entry)
+
+    batches = []
+    for entries in endpoints.values():
+        for i in range(0, len(entries), GRAPHQL_BATCH_SIZE):
+            batches.append(entries[i:i + GRAPHQL_BATCH_SIZE])
+
+    result = {}
+    for batch in batches:
+        github = batch[0]["github"]
+        if github.github_key == None:
+            # The GraphQL API cannot be used anonymously
+            continue
+
+        variables = {}
+        selections = []
+        for index, entry in enumerate(batch):
+            variables[f"owner{index}"] = entry["github"].user
+            variables[f"name{index}"] = entry["github"].repo
+            selections.append(build_repository_query(index, entry["queries"]))
+
+        declarations = ", ".join(f"$owner{index}: String!, $name{index}: String!" for index in range(len(batch)))
+        query = f"query({declarations}) {{ {' '.join(selections)} }}"
+
+        response = lib.http_post(github.graphql_url, json={ "query": query, "variables": variables }, headers=get_api_headers(github.github_key), timeout=30)
+        if response.status_code != 200:
+            print(f"GitHub generator - GraphQL batch failed with HTTP {response.status_code}, falling back to the REST API", file=sys.stderr)
+            continue
+
+        data = response.json().get("data") or {}
+        for index, entry in enumerate(batch):
+            node = data.get(f"r{index}")
+            if node == None:
+                continue
+
+            # Packages only get the data of their own query, as packages of the same repository may need
+            # data that can't be used for others, like the alphabetically ordered tags of pinned tags
+            converted = convert_repository(entry["github"], node, entry["queries"])
+            for name, query in entry["packages"]:
+                result[name] = { key: value for key, value in converted.items() if key == "repository" or key == query }
+
+    return result
+
+def parse_input(x):
     data = json.loads(x)
 
     pkgname = data["name"]
     if "github" not in data:
         raise lib.TinyError(f"No object named \"github\" found inside the \"{pkgname}\" package's metadata!")
    
-    github_data = GitHubData(data["github"], pkgname)
+    prefetched = data["prefetched"] if "prefetched" in data else None
+    return pkgname, GitHubData(data["github"], pkgname), prefetched
+
+def probe(x):
+    pkgname, github_data, prefetched = parse_input(x)
+    if github_data.query == "commits":
+        version, urls = resolve_commit(github_data, prefetched)
+    else:
+        version, urls = resolve_release_or_tag(pkgname, github_data, prefetched)
+    return { "version": version, "urls": urls }
+
+def generate(x):
+    pkgname, github_data, prefetched = parse_input(x)
     if github_data.query == "commits":
-        print(generate_commit(github_data))
+        return generate_commit(github_data, prefetched)
     elif github_data.query == "tags" or github_data.query == "releases":
-        print(generate_release_or_tag(pkgname, github_data))
+        return generate_release_or_tag(pkgname, github_data, prefetched)
 
 
 
-generate(lib.readinput())
+lib.run(generate, prepare, probe)
 
 #generate("""
 #{
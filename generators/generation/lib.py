@@ -3,9 +3,18 @@
 import hashlib
 import sys
 import os
+import io
+import json
+import struct
+import time
+import threading
+import traceback
+import requests
 import yaml
-from tqdm import tqdm
-from io import BytesIO
+from urllib.parse import urlsplit
+from contextlib import redirect_stdout, redirect_stderr, contextmanager
+from multiprocessing.managers import BaseManager
+from concurrent.futures import ThreadPoolExecutor
 
 def load_secrets():
     if os.name == 'nt':
@@ -23,52 +32,778 @@ def load_secrets():
         result = yaml.safe_load(stream)
         return result if result is not None else {}
 
+def get_cache_dir():
+    if os.name == 'nt':
+        base_dir = os.getenv('LOCALAPPDATA', os.path.expanduser('~\\AppData\\Local'))
+    else:
+        base_dir = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base_dir, 'pkggen')
+
 def readinput():
     return sys.stdin.buffer.read()
 
+def write_frame(stream, obj):
+    payload = json.dumps(obj).encode("utf-8")
+    stream.write(struct.pack(">I", len(payload)) + payload)
+    stream.flush()
+
+def read_frame(stream):
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    (length, ) = struct.unpack(">I", header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return json.loads(payload)
+
+# Progress events are written as JSON lines to a pipe shared by every generator of a run. Writes below
+# PIPE_BUF are atomic, so events from concurrent generators never interleave
+PROGRESS_INTERVAL = 0.1
+
+current_package = None
+
+def get_progress_fd():
+    fd = os.getenv("PKGGEN_PROGRESS_FD")
+    return int(fd) if fd is not None else None
+
+def report(event, **fields):
+    """
+    Sends a structured progress event to the driver, for example:
+
+        { "event": "download", "package": "pkgname", "time": 1700000000.0, "url": "...", "bytes": 1024, "total": 4096 }
+
+    Events are dropped when the generator is not started by the driver.
+    """
+    fd = get_progress_fd()
+    if fd is None:
+        return
+
+    fields.update({ "event": event, "package": current_package, "time": time.time() })
+    try:
+        os.write(fd, (json.dumps(fields) + "\n").encode("utf-8"))
+    except OSError:
+        pass
+
+def is_tracing():
+    return os.getenv("PKGGEN_TRACE") is not None and get_progress_fd() is not None
+
+@contextmanager
+def span(name, **args):
+    """
+    Records how long the wrapped code took when the driver was started with --trace. The yielded dict can
+    be used to attach results to the span, for example the number of bytes that were downloaded.
+    """
+    if not is_tracing():
+        yield args
+        return
+
+    start = time.time()
+    try:
+        yield args
+    finally:
+        report("span", name=name, start=start, end=time.time(), pid=os.getpid(), tid=threading.get_ident(), args=args)
+
+def run_task(function, js, mode):
+    global current_package
+    try:
+        current_package = json.loads(js).get("name")
+    except (ValueError, AttributeError):
+        current_package = None
+
+    report("start", mode=mode)
+    try:
+        with span("task", mode=mode):
+            return function(js)
+    finally:
+        report("finish", mode=mode)
+
+def open_result_stream():
+    # Results go to a private copy of stdout, while the real stdout is pointed at stderr so that logs
+    # and stray writes from native code can never corrupt them
+    sys.stdout.flush()
+    stream = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return stream
+
+def write_result(stream, result):
+    stream.write((json.dumps(result) + "\n").encode("utf-8"))
+    stream.flush()
+
+def serve(stream, generate, probe=None):
+    frames_in = sys.stdin.buffer
+
+    while True:
+        task = read_frame(frames_in)
+        if task is None:
+            break
+
+        result = None
+        stderr = io.StringIO()
+        returncode = 0
+        with redirect_stdout(stderr), redirect_stderr(stderr):
+            try:
+                mode = task.get("mode")
+                function = generate if mode != "probe" else (probe if probe is not None else lambda js: None)
+                result = run_task(function, task["input"], mode)
+            except SystemExit as e:
+                returncode = e.code if type(e.code) == int else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+
+        write_frame(stream, {
+            "returncode": returncode,
+            "stdout": json.dumps(result) if returncode == 0 else "",
+            "stderr": stderr.getvalue(),
+        })
+
+def run(generate, prepare=None, probe=None):
+    """
+    Runs a generator. Besides generating a single package from stdin, generators can be started as a
+    persistent worker(--worker), asked to resolve a batch of packages upfront(--prepare), or asked for a
+    cheap fingerprint of a package's upstream version and artifacts without downloading them(--probe).
+
+    Generators return their result, which is written to stdout as a single JSON document. Everything the
+    generator prints goes to stderr.
+    """
+    stream = open_result_stream()
+    if "--worker" in sys.argv[1:]:
+        serve(stream, generate, probe)
+    elif "--prepare" in sys.argv[1:]:
+        packages = json.loads(readinput())
+        write_result(stream, prepare(packages) if prepare is not None else {})
+    elif "--probe" in sys.argv[1:]:
+        write_result(stream, run_task(probe, readinput(), "probe") if probe is not None else None)
+    else:
+        write_result(stream, run_task(generate, readinput(), None))
+
 class TinyError(Exception):
     def __init__(self, message):
         super().__init__("\x1b[31m" + message + "\x1b[0m")
         self.args = (message, )
         self.__traceback__ = None
 
-def calculate_hash(obj, data, algorithm, key):
-    if key != "blake2b" or key != "blake2s":
-        h = hashlib.new(algorithm, usedforsecurity=False)
-    else:
-        h = hashlib.blake2b(digest_size=64) if key == "blake2b" else hashlib.blake2s(digest_size=32)
-    h.update(data)
-    obj[key] = h.hexdigest()
+# Maps the checksum keys exported by generators to hashlib algorithm names
+HASH_ALGORITHMS = {
+    "md5":      "md5",
+    "sha1":     "sha1",
+    "sha2-224": "sha224",
+    "sha3-224": "sha3_224",
+    "sha2-256": "sha256",
+    "sha3-256": "sha3_256",
+    "sha2-384": "sha384",
+    "sha3-384": "sha3_384",
+    "sha2-512": "sha512",
+    "sha3-512": "sha3_512",
+    "blake2b":  "blake2b",
+    "blake2s":  "blake2s",
+}
+
+# Downloads above this size spread digest updates across threads. hashlib releases the GIL
+# while hashing large buffers, so the digests are computed concurrently
+PARALLEL_HASH_THRESHOLD = 1024 * 1024 * 16
+
+CHUNK_SIZE = 1024 * 64
+PARALLEL_CHUNK_SIZE = 1024 * 1024
+
+hash_executor = None
+
+def get_hash_executor():
+    global hash_executor
+    if hash_executor is None:
+        hash_executor = ThreadPoolExecutor(max_workers=len(HASH_ALGORITHMS), thread_name_prefix="pkggen-hash")
+    return hash_executor
+
+class MultiHasher:
+    def __init__(self, keys=None, parallel=False):
+        self.hashes = {
+            key: hashlib.new(HASH_ALGORITHMS[key], usedforsecurity=False)
+            for key in (keys if keys is not None else HASH_ALGORITHMS.keys())
+        }
+        self.parallel = parallel and len(self.hashes) > 1 and (os.cpu_count() or 1) > 1
+        self.chunk_size = PARALLEL_CHUNK_SIZE if self.parallel else CHUNK_SIZE
+
+    def update(self, chunk):
+        if self.parallel:
+            list(get_hash_executor().map(lambda h: h.update(chunk), self.hashes.values()))
+        else:
+            for h in self.hashes.values():
+                h.update(chunk)
+
+    def hexdigests(self):
+        return { key: h.hexdigest() for key, h in self.hashes.items() }
+
+def get_checksum_keys():
+    # The driver exports the checksums referenced by the distribution templates. Everything is computed
+    # when running a generator on its own
+    keys = os.getenv("PKGGEN_CHECKSUMS")
+    if keys is None:
+        return list(HASH_ALGORITHMS.keys())
+    return [ key for key in keys.split(",") if key in HASH_ALGORITHMS ]
+
+def get_artifact_path(url):
+    return os.path.join(get_cache_dir(), "artifacts", hashlib.sha256(url.encode("utf-8")).hexdigest())
 
 def calculate_hashes(obj, data):
-    calculate_hash(obj, data, "md5", "md5")
+    with span("hash", bytes=len(data)):
+        hasher = MultiHasher(parallel=len(data) >= PARALLEL_HASH_THRESHOLD)
+        hasher.update(data)
+        obj.update(hasher.hexdigests())
+
+def download_and_hash(response, size, url, keys=None):
+    if keys is None:
+        keys = get_checksum_keys()
+    hasher = MultiHasher(keys, parallel=size >= PARALLEL_HASH_THRESHOLD)
+
+    # When only some checksums are computed, the artifact is kept on disk so that the rest can be
+    # computed lazily if a template ends up needing them
+    spool = None
+    if len(keys) < len(HASH_ALGORITHMS):
+        path = get_artifact_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        spool = open(f"{path}.{os.getpid()}.part", "wb")
+
+    received = 0
+    reported = 0.0
+    hashing = 0.0
+    report("download", url=url, bytes=0, total=size)
+    try:
+        with span("download", url=url) as args:
+            for chunk in response.iter_content(chunk_size=hasher.chunk_size):
+                if not chunk:
+                    continue
+                start = time.perf_counter()
+                hasher.update(chunk)
+                hashing += time.perf_counter() - start
+                if spool is not None:
+                    spool.write(chunk)
+
+                received += len(chunk)
+                if time.time() - reported >= PROGRESS_INTERVAL:
+                    reported = time.time()
+                    report("download", url=url, bytes=received, total=size)
+
+            # Hashing happens while downloading, the time spent in the digests is reported separately
+            args.update({ "bytes": received, "hash-seconds": hashing })
+    except BaseException:
+        if spool is not None:
+            spool.close()
+            os.remove(spool.name)
+        raise
+
+    if spool is not None:
+        spool.close()
+        os.replace(spool.name, path)
+
+    report("download", url=url, bytes=received, total=size)
+    return hasher.hexdigests()
+
+# Artifacts above this size are downloaded as concurrent byte ranges when the server supports them
+SEGMENTED_DOWNLOAD_THRESHOLD = 1024 * 1024 * 64
+DOWNLOAD_SEGMENTS = 4
+MAX_SEGMENT_RETRIES = 5
+SEGMENT_STATE_INTERVAL = 1024 * 1024 * 8
+
+class RangesNotHonored(Exception):
+    pass
+
+def supports_segmented_download(response, size):
+    return (
+        size >= SEGMENTED_DOWNLOAD_THRESHOLD
+        and response.headers.get("Accept-Ranges") == "bytes"
+        and response.headers.get("Content-Encoding", "identity") == "identity"
+    )
+
+def get_range_validator(headers):
+    # If-Range needs a strong validator, otherwise a changed artifact could be stitched together from
+    # two different versions
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+def load_segment_state(state_path, partial_path, url, size, validator):
+    if validator is None:
+        return None
+    try:
+        with open(state_path, "r") as stream:
+            state = json.load(stream)
+        if state["url"] == url and state["size"] == size and state["validator"] == validator and os.path.getsize(partial_path) == size:
+            return state["segments"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def store_segment_state(state_path, url, size, validator, segments):
+    tmp = f"{state_path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as stream:
+        json.dump({ "url": url, "size": size, "validator": validator, "segments": segments }, stream)
+    os.replace(tmp, state_path)
+
+def download_segments(url, headers, size, validator, partial_path, state_path):
+    """
+    Downloads the missing parts of every segment into the preallocated partial file. Segments are
+    [start, end, next offset] triples, which are persisted regularly so that an interrupted download
+    resumes where it stopped, even in a later run.
+    """
+    segments = load_segment_state(state_path, partial_path, url, size, validator)
+    if segments is None:
+        step = -(-size // DOWNLOAD_SEGMENTS)
+        segments = [ [ start, min(start + step, size) - 1, start ] for start in range(0, size, step) ]
+        with open(partial_path, "wb") as stream:
+            stream.truncate(size)
+
+    lock = threading.Lock()
+    progress = { "received": sum(segment[2] - segment[0] for segment in segments), "saved": 0, "reported": 0.0 }
+
+    def update(segment, length):
+        with lock:
+            segment[2] += length
+            progress["received"] += length
+            if validator is not None and progress["received"] - progress["saved"] >= SEGMENT_STATE_INTERVAL:
+                progress["saved"] = progress["received"]
+                store_segment_state(state_path, url, size, validator, segments)
+            if time.time() - progress["reported"] >= PROGRESS_INTERVAL:
+                progress["reported"] = time.time()
+                report("download", url=url, bytes=progress["received"], total=size)
+
+    def fetch_segment(segment):
+        error = None
+        for attempt in range(MAX_SEGMENT_RETRIES + 1):
+            if segment[2] > segment[1]:
+                return
+            if attempt > 0:
+                time.sleep(min(2 ** attempt, 30))
+
+            request_headers = dict(headers, **{ "Range": f"bytes={segment[2]}-{segment[1]}", "Accept-Encoding": "identity" })
+            if validator is not None:
+                request_headers["If-Range"] = validator
+
+            try:
+                with span("segment", url=url, start=segment[2], end=segment[1], attempt=attempt):
+                    response = http_get(url, headers=request_headers, timeout=10, stream=True)
+                    if response.status_code != 206 or not response.headers.get("Content-Range", "").startswith(f"bytes {segment[2]}-"):
+                        response.close()
+                        raise RangesNotHonored()
+
+                    # Unbuffered writes reach the OS right away, so the persisted offsets never get ahead of
+                    # the data in the file
+                    with open(partial_path, "r+b", buffering=0) as stream:
+                        stream.seek(segment[2])
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            chunk = chunk[:segment[1] + 1 - segment[2]]
+                            if not chunk:
+                                continue
+                            stream.write(chunk)
+                            update(segment, len(chunk))
+                    response.close()
+            except (requests.RequestException, OSError) as e:
+                error = e
+        if segment[2] <= segment[1]:
+            raise TinyError(f"Failed to download {url} after {MAX_SEGMENT_RETRIES + 1} attempts: {error}")
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        list(executor.map(fetch_segment, segments))
+
+def download_segmented(url, headers, size, response_headers, keys=None):
+    """
+    Downloads a large artifact as concurrent byte ranges, retrying every range on its own, and hashes the
+    assembled file. Returns None when the server doesn't honor range requests after all.
+    """
+    if keys is None:
+        keys = get_checksum_keys()
+    validator = get_range_validator(response_headers)
+
+    path = get_artifact_path(url)
+    partial_path = f"{path}.partial"
+    state_path = f"{path}.segments.json"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with span("download", url=url, bytes=size, segmented=True):
+        try:
+            download_segments(url, dict(headers) if headers is not None else {}, size, validator, partial_path, state_path)
+        except RangesNotHonored:
+            # The artifact changed since the first response, or the server ignores ranges
+            for leftover in [ partial_path, state_path ]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            return None
+    report("download", url=url, bytes=size, total=size)
+
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    checksums = hash_file(partial_path, keys)
+
+    # Like streamed downloads, the artifact is only kept when some checksums may be needed later
+    if len(keys) < len(HASH_ALGORITHMS):
+        os.replace(partial_path, path)
+    else:
+        os.remove(partial_path)
+    return checksums
+
+DEFAULT_HOST_CONNECTIONS = 8
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_host_limits():
+    try:
+        return json.loads(os.getenv("PKGGEN_HOST_LIMITS", "{}"))
+    except ValueError:
+        return {}
+
+class HostSession(requests.Session):
+    """
+    A session that only keeps connections to a single host. Redirects to other hosts, like from the GitHub
+    API to codeload.github.com, are sent through the session of the host they lead to, so that they don't
+    evict the pooled connections of this one.
+    """
+    def __init__(self, host):
+        super().__init__()
+        self.host = host
+
+    def get_adapter(self, url):
+        host = urlsplit(url).netloc
+        if host != self.host:
+            return get_session(host).get_adapter(url)
+        return super().get_adapter(url)
+
+def get_session(host):
+    """
+    Returns the keep-alive session shared by every request to the given host. Connections are pooled for
+    the lifetime of the generator process, which with worker pools spans many packages. Requests block
+    once the host's connection limit is reached instead of opening new sockets.
+    """
+    with sessions_lock:
+        if host not in sessions:
+            limits = get_host_limits()
+            limit = int(limits.get(host, limits.get("*", DEFAULT_HOST_CONNECTIONS)))
+
+            session = HostSession(host)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=limit, pool_block=True)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[host] = session
+        return sessions[host]
+
+class SchedulerManager(BaseManager):
+    pass
+
+SchedulerManager.register("get_scheduler")
+SchedulerManager.register("get_artifacts")
+
+manager = None
+scheduler = None
+artifacts = None
+scheduler_lock = threading.Lock()
+
+def get_manager():
+    global manager
+    address = os.getenv("PKGGEN_SCHEDULER_ADDRESS")
+    if manager is None and address is not None:
+        host, port = address.rsplit(":", 1)
+        manager = SchedulerManager(address=(host, int(port)), authkey=bytes.fromhex(os.getenv("PKGGEN_SCHEDULER_AUTHKEY", "")))
+        manager.connect()
+    return manager
+
+def get_scheduler():
+    """
+    Connects to the rate limit scheduler shared by all generator processes of a run. Returns None when the
+    generator is launched on its own.
+    """
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None and get_manager() is not None:
+            scheduler = manager.get_scheduler()
+        return scheduler
+
+def get_artifacts():
+    """
+    Connects to the coordinator that merges downloads of the same artifact across generator processes.
+    Returns None when the generator is launched on its own.
+    """
+    global artifacts
+    with scheduler_lock:
+        if artifacts is None and get_manager() is not None:
+            artifacts = manager.get_artifacts()
+        return artifacts
+
+def get_header_number(headers, key):
+    try:
+        return float(headers[key]) if key in headers else None
+    except ValueError:
+        return None
+
+def is_rate_limited(response):
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and (response.headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in response.headers)
+
+def get_rate_limit_delay(response):
+    retry_after = get_header_number(response.headers, "Retry-After")
+    if retry_after is not None:
+        return retry_after
+
+    reset = get_header_number(response.headers, "X-RateLimit-Reset")
+    return max(reset - time.time(), 1) if reset is not None else 60
+
+# Rate limited requests are retried after the quota resets instead of failing the package
+MAX_RATE_LIMIT_RETRIES = 5
+
+def http_request(method, url, **kwargs):
+    host = urlsplit(url).netloc
+    session = get_session(host)
+    headers = kwargs.get("headers") or {}
+    identity = hashlib.sha256(headers.get("Authorization", "").encode("utf-8")).hexdigest()[:16]
+    shared = get_scheduler()
+
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        if shared is not None:
+            delay = shared.acquire(host, identity)
+            if delay > 0:
+                report("phase", phase="waiting", host=host, seconds=delay)
+                with span("rate-limit-wait", host=host):
+                    time.sleep(delay)
+
+        with span("request", method=method, url=url) as args:
+            response = session.request(method, url, **kwargs)
+            args["status"] = response.status_code
+
+        limit = get_header_number(response.headers, "X-RateLimit-Limit")
+        remaining = get_header_number(response.headers, "X-RateLimit-Remaining")
+        reset = get_header_number(response.headers, "X-RateLimit-Reset")
+        retry_after = get_header_number(response.headers, "Retry-After")
+        if shared is not None and (remaining is not None or retry_after is not None):
+            shared.update(host, identity, limit, remaining, reset, retry_after)
+
+        if not is_rate_limited(response) or attempt == MAX_RATE_LIMIT_RETRIES:
+            return response
+
+        response.close()
+        print(f"\x1b[33mWarning: rate limited by {host}, waiting for the quota to reset.\x1b[0m", file=sys.stderr)
+
+        # The shared scheduler delays the next attempt by itself if the response told it when to retry
+        if shared is None or (remaining is None and retry_after is None):
+            time.sleep(get_rate_limit_delay(response))
+
+def http_get(url, **kwargs):
+    return http_request("GET", url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http_request("POST", url, **kwargs)
+
+def is_cache_enabled():
+    return os.getenv("PKGGEN_NO_CACHE") is None
+
+def probe_artifact(url, headers=None):
+    """
+    Returns the validators of an artifact from a HEAD request, without downloading it. Servers that don't
+    support HEAD are sent a GET whose body is never read.
+    """
+    response = http_request("HEAD", url, headers=headers, timeout=10, allow_redirects=True)
+    if response.status_code == 405 or response.status_code == 501:
+        response = http_get(url, headers=headers, timeout=10, stream=True)
+    response.close()
+    if response.status_code != 200:
+        raise TinyError(f"Failed to probe file with URL: {url}. HTTP Response: {response.status_code} {response.reason}.")
+
+    return {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last-modified": response.headers.get("Last-Modified"),
+        "size": int(response.headers.get("Content-Length", 0)),
+    }
+
+def get_artifact_metadata_path(url):
+    return os.path.join(get_cache_dir(), "artifact-metadata", hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+def load_artifact_metadata(url):
+    try:
+        with open(get_artifact_metadata_path(url), "r") as stream:
+            metadata = json.load(stream)
+            return metadata if metadata.get("url") == url else None
+    except (OSError, ValueError):
+        return None
+
+def store_artifact_metadata(url, metadata):
+    path = get_artifact_metadata_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as stream:
+        json.dump(metadata, stream)
+    os.replace(tmp, path)
+
+class CachedResponse:
+    def __init__(self, url, status_code, headers, text):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+def get_response_cache_path(url, headers):
+    # Responses differ between users, so the key includes a hash of the credentials
+    identity = hashlib.sha256(headers.get("Authorization", "").encode("utf-8")).hexdigest()
+    key = hashlib.sha256(f"{identity}\0{url}".encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir(), "api-responses", key + ".json")
+
+def cached_get(url, headers=None, **kwargs):
+    """
+    Performs a GET request for an API response, revalidating a previously cached response with
+    If-None-Match. A 304 Not Modified is answered from the cache, which for the GitHub API also does not
+    count against the rate limit.
+    """
+    request_headers = dict(headers) if headers is not None else {}
+    path = get_response_cache_path(url, request_headers)
+
+    cached = None
+    if is_cache_enabled():
+        try:
+            with open(path, "r") as stream:
+                cached = json.load(stream)
+                if cached.get("url") != url:
+                    cached = None
+        except (OSError, ValueError):
+            cached = None
+    if cached is not None:
+        request_headers["If-None-Match"] = cached["etag"]
+
+    response = http_get(url, headers=request_headers, **kwargs)
+    if response.status_code == 304 and cached is not None:
+        os.utime(path)
+        return CachedResponse(url, 200, response.headers, cached["body"])
+
+    if response.status_code == 200 and "ETag" in response.headers:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as stream:
+            json.dump({ "url": url, "etag": response.headers["ETag"], "body": response.text }, stream)
+        os.replace(tmp, path)
+
+    return response
+
+def hash_file(path, keys):
+    report("phase", phase="hashing", keys=keys)
+    with span("hash", bytes=os.path.getsize(path), keys=keys):
+        hasher = MultiHasher(keys, parallel=os.path.getsize(path) >= PARALLEL_HASH_THRESHOLD)
+        with open(path, "rb") as stream:
+            while chunk := stream.read(hasher.chunk_size):
+                hasher.update(chunk)
+        return hasher.hexdigests()
+
+def fetch_artifact(url, headers=None, keys=None, error=None):
+    """
+    Downloads and hashes an artifact, returning its "tarball-urls" entry. Within a run of the driver, every
+    artifact is only fetched once, packages that share it wait for the first one to finish instead.
+    """
+    if keys is None:
+        keys = get_checksum_keys()
+    shared = get_artifacts()
+    if shared is None:
+        return download_artifact(url, headers, keys, error)
+
+    with span("artifact-wait", url=url):
+        result = shared.claim(url, keys, os.getpid())
+    if result is not None:
+        result["checksums"] = { key: result["checksums"][key] for key in keys }
+        return result
+
+    result = None
+    try:
+        result = download_artifact(url, headers, keys, error)
+    finally:
+        shared.complete(url, result)
+    return result
+
+def add_validators(result, etag, last_modified):
+    # Recorded in pkggen.lock, so that probes can tell when an artifact changed without changing its URL
+    if etag is not None:
+        result["etag"] = etag
+    if last_modified is not None:
+        result["last-modified"] = last_modified
+
+def download_artifact(url, headers=None, keys=None, error=None):
+    """
+    Downloads and hashes an artifact. Checksums and sizes are cached by URL together with the ETag and
+    Last-Modified headers, so an unchanged artifact only costs a conditional request that the server
+    answers with 304 Not Modified.
+    """
+    if keys is None:
+        keys = get_checksum_keys()
+    request_headers = dict(headers) if headers is not None else {}
 
-    calculate_hash(obj, data, "sha1", "sha1")
+    metadata = load_artifact_metadata(url) if is_cache_enabled() else None
+    if metadata is not None:
+        missing = [ key for key in keys if key not in metadata["checksums"] ]
+        if len(missing) == 0 or os.path.exists(get_artifact_path(url)):
+            if "etag" in metadata:
+                request_headers["If-None-Match"] = metadata["etag"]
+            if "last-modified" in metadata:
+                request_headers["If-Modified-Since"] = metadata["last-modified"]
+        else:
+            metadata = None
 
-    calculate_hash(obj, data, "sha224", "sha2-224")
-    calculate_hash(obj, data, "sha3_224", "sha3-224")
+    response = http_get(url, headers=request_headers, timeout=10, stream=True)
+    if response.status_code == 304 and metadata is not None:
+        response.close()
 
-    calculate_hash(obj, data, "sha256", "sha2-256")
-    calculate_hash(obj, data, "sha3_256", "sha3-256")
-    
-    calculate_hash(obj, data, "sha384", "sha2-384")
-    calculate_hash(obj, data, "sha3_384", "sha3-384")
+        artifact_path = get_artifact_path(url)
+        missing = [ key for key in keys if key not in metadata["checksums"] ]
+        if len(missing) > 0:
+            metadata["checksums"].update(hash_file(artifact_path, missing))
+        if os.path.exists(artifact_path):
+            os.utime(artifact_path)
+        store_artifact_metadata(url, metadata)
 
-    calculate_hash(obj, data, "sha512", "sha2-512")
-    calculate_hash(obj, data, "sha3_512", "sha3-512")
+        result = {
+            "url": url,
+            "checksums": { key: metadata["checksums"][key] for key in keys }
+        }
+        if metadata["size"] != 0:
+            result["size"] = metadata["size"]
+        add_validators(result, metadata.get("etag"), metadata.get("last-modified"))
+        return result
 
-    calculate_hash(obj, data, "blake2b", "blake2b")
-    calculate_hash(obj, data, "blake2s", "blake2s")
+    if response.status_code != 200:
+        response.close()
+        raise TinyError(error if error is not None else f"Failed to fetch file with URL: {url}. HTTP Response: {response.status_code} {response.reason}.")
 
+    size = int(response.headers.get("content-length", 0))
+    checksums = None
+    if supports_segmented_download(response, size):
+        response.close()
+        checksums = download_segmented(url, headers, size, response.headers, keys)
+        if checksums is None:
+            response = http_get(url, headers=headers, timeout=10, stream=True)
+            if response.status_code != 200:
+                response.close()
+                raise TinyError(error if error is not None else f"Failed to fetch file with URL: {url}. HTTP Response: {response.status_code} {response.reason}.")
+    if checksums is None:
+        checksums = download_and_hash(response, size, url, keys)
 
-def download_to_buffer(response, size, url):
-    buf = BytesIO()
+    result = {
+        "url": url,
+        "checksums": checksums
+    }
+    if size != 0:
+        result["size"] = size
+    add_validators(result, response.headers.get("ETag"), response.headers.get("Last-Modified"))
 
-    with tqdm(total=size if size > 0 else None, unit="B", unit_scale=True, desc=f"Downloading {url}: ") as pbar:
-        for chunk in response.iter_content(chunk_size=1024 * 64):
-            if not chunk:
-                continue
-            buf.write(chunk)
-            pbar.update(len(chunk))
+    if "ETag" in response.headers or "Last-Modified" in response.headers:
+        metadata = {
+            "url": url,
+            "size": size,
+            "checksums": result["checksums"],
+            "fetched": time.time(),
+        }
+        if "ETag" in response.headers:
+            metadata["etag"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            metadata["last-modified"] = response.headers["Last-Modified"]
+        store_artifact_metadata(url, metadata)
 
-    return buf
+    return result
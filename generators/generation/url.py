@@ -48,6 +48,8 @@ Output:
             {
                 "url": "https://example.com",
                 "size": "1234", //Optional
+                "etag": "\"etag\"", // Optional, the ETag header of the artifact
+                "last-modified": "date", // Optional, the Last-Modified header of the artifact
                 "checksums":
                 {
                     "sha2-512": "hash",
@@ -77,12 +79,12 @@ Output:
 """
 
 import json
-import requests
 import re
+import sys
 import lib
 
 
-def generate(x):
+def parse_input(x):
     data = json.loads(x)
     
     pkgname = data["name"]
@@ -93,77 +95,83 @@ def generate(x):
 
     if "url" not in urldata:
         raise lib.TinyError(f"No string entry named \"url\" found inside the \"{pkgname}\" package's metadata!")
-    
-    locks = urldata["hash-locks"] if "hash-locks" in urldata else None
 
     version = urldata["version"] if "version" in urldata else None
     transforms = urldata["transforms"] if "transforms" in urldata else None
 
-    url = urldata["url"].format(pkgname=pkgname, version=version if version != None else "")
-
     if transforms != None and version != None:
         raise lib.TinyError(f"The URL generator does not support having both \"version\" and \"transform\" keys at the same time.")
 
+    return pkgname, urldata, urldata["url"].format(pkgname=pkgname, version=version if version != None else "")
+
+def get_version(urldata, url):
+    if "version" in urldata:
+        return urldata["version"]
+    elif "transforms" in urldata:
+        urltmp = url
+
+        for transform in urldata["transforms"]:
+            if type(transform) == list and len(transform) >= 2:
+                urltmp = re.sub(transform[0], transform[1], urltmp)
+            else:
+                raise lib.TinyError(f"Elements of the transforms array must be arrays with 2 elements!")
+
+        return urltmp
+    return None
+
+def get_headers(urldata):
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.5 Safari/605.1.15',
     }
-    headers = urldata["headers"] if "headers" in urldata else headers
-    
-    print(f"URL generator - Generating package: {pkgname}")
+    return urldata["headers"] if "headers" in urldata else headers
+
+def probe(x):
+    # The version and URL are derived from the configuration alone, so the artifact itself is checked for
+    # new content behind the same URL
+    pkgname, urldata, url = parse_input(x)
+    return {
+        "version": get_version(urldata, url),
+        "urls": [ url ],
+        "artifacts": [ lib.probe_artifact(url, get_headers(urldata)) ]
+    }
 
-    response = requests.get(url, headers=headers, timeout=10, stream=True)
-    response.raise_for_status()
-    size = int(response.headers.get("content-length", 0))
+def generate(x):
+    pkgname, urldata, url = parse_input(x)
+    locks = urldata["hash-locks"] if "hash-locks" in urldata else None
+    headers = get_headers(urldata)
+    
+    print(f"URL generator - Generating package: {pkgname}", file=sys.stderr)
 
-    if response.status_code == 200:
-        buf = lib.download_to_buffer(response, size, url)
-        
+    with lib.span("artifact", url=url):
         result = {
             "tarball-urls": [
-                {
-                    "url": url,
-                    "checksums": {}
-                }
+                # Hash locks can match any checksum, so all of them are needed to verify them
+                lib.fetch_artifact(url, headers, list(lib.HASH_ALGORITHMS.keys()) if locks != None else None)
             ]
         }
-        lib.calculate_hashes(result["tarball-urls"][0]["checksums"], buf.getvalue())
-        
-        if locks != None:
-            is_matching_lock = False
-            for val in result["tarball-urls"][0]["checksums"].values():
-                for h in locks:
-                    if val == h:
-                        is_matching_lock = True
-                        break
-
-                if is_matching_lock:
+    
+    if locks != None:
+        is_matching_lock = False
+        for val in result["tarball-urls"][0]["checksums"].values():
+            for h in locks:
+                if val == h:
+                    is_matching_lock = True
                     break
 
-            if not is_matching_lock:
-                raise lib.TinyError(f"Checksums calculated for URL({urldata['url']}) do not match any locked checksums!")
-
-        if version != None:
-            result["version"] = version
-        elif transforms != None:
-            urltmp = url
+            if is_matching_lock:
+                break
 
-            for transform in transforms:
-                if type(transform) == list and len(transform) >= 2:
-                    urltmp = re.sub(transform[0], transform[1], urltmp)
-                else:
-                    raise lib.TinyError(f"Elements of the transforms array must be arrays with 2 elements!")
+        if not is_matching_lock:
+            raise lib.TinyError(f"Checksums calculated for URL({urldata['url']}) do not match any locked checksums!")
 
-            result["version"] = urltmp
+    version = get_version(urldata, url)
+    if version != None:
+        result["version"] = version
 
-        if size != 0:
-            result["tarball-urls"][0]["size"] = size
+    return result
 
-        print(result)
-    else:
-        raise lib.TinyError(f"Failed to fetch file with URL: {urldata['url']}. HTTP Response: {response.status_code} {response.reason}.")
-        
 
-generate(lib.readinput())
+lib.run(generate, probe=probe)
 #generate("""
 #{
 #    "name": "untitled-exec",
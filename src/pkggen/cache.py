@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import os
+import time
+import utils
+
+DEFAULT_MAX_AGE = 60 * 60 * 24 * 30
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024 * 4
+
+CACHE_DIRECTORIES = [ "artifacts", "artifact-metadata", "api-responses", "templates", "repology", "config" ]
+
+def parse_size(value):
+    if type(value) == int:
+        return value
+
+    units = { "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4 }
+    value = str(value).strip().upper().removesuffix("IB").removesuffix("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_age(value):
+    if type(value) == int:
+        return value
+
+    units = { "s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24, "w": 60 * 60 * 24 * 7 }
+    value = str(value).strip()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def evict(config=None):
+    """
+    Removes cache entries that were not used within the configured maximum age, then removes the least
+    recently used entries until the cache fits within the maximum size. Configured through the "cache"
+    key in pkggen.yaml, for example:
+
+        cache:
+          max-age: "30d"
+          max-size: "4GiB"
+    """
+    config = config if config != None else {}
+    max_age = parse_age(config.get("max-age", DEFAULT_MAX_AGE))
+    max_size = parse_size(config.get("max-size", DEFAULT_MAX_SIZE))
+
+    cache_dir = utils.get_cache_dir()
+    entries = []
+    for directory in CACHE_DIRECTORIES:
+        path = os.path.join(cache_dir, directory)
+        if not os.path.isdir(path):
+            continue
+
+        for entry in os.scandir(path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    now = time.time()
+    kept = []
+    for mtime, size, path in entries:
+        if now - mtime > max_age:
+            remove(path)
+        else:
+            kept.append((mtime, size, path))
+
+    kept.sort()
+    total = sum(size for _, size, _ in kept)
+    for _, size, path in kept:
+        if total <= max_size:
+            break
+        remove(path)
+        total -= size
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import os
+import re
+import utils
+
+lib = utils.get_generator_lib()
+
+# Maps the checksum keys exported by generators to hashlib algorithm names
+HASH_ALGORITHMS = lib.HASH_ALGORITHMS
+
+CHECKSUM_REGEX = re.compile(r"(?<![\w-])(" + "|".join(re.escape(key) for key in HASH_ALGORITHMS) + r")(?![\w-])")
+
+def scan_templates(run_path, distributions):
+    keys = set()
+    found_templates = False
+
+    for distribution in distributions:
+        template_dir = os.path.join(run_path, utils.get_distribution_name(distribution))
+        if not os.path.isdir(template_dir):
+            continue
+
+        for root, _, files in os.walk(template_dir):
+            for file in files:
+                found_templates = True
+                with open(os.path.join(root, file), "r", errors="ignore") as stream:
+                    keys.update(CHECKSUM_REGEX.findall(stream.read()))
+
+    return keys if found_templates else None
+
+def get_checksum_keys(pkggen):
+    """
+    Returns the list of checksum keys that need to be computed for every artifact. An explicit "checksums"
+    list in pkggen.yaml takes priority, otherwise the distribution templates are scanned for the keys they
+    reference. None is returned when no templates exist, in which case every checksum is computed.
+    """
+    if "checksums" in pkggen:
+        keys = pkggen["checksums"] if pkggen["checksums"] != None else []
+        for key in keys:
+            if key not in HASH_ALGORITHMS:
+                raise utils.GenericError(f"Unknown checksum \"{key}\"! Supported checksums: {', '.join(HASH_ALGORITHMS)}")
+    else:
+        keys = scan_templates(utils.get_run_path(), utils.load_distributions())
+        if keys is None:
+            return None
+
+    return [ key for key in HASH_ALGORITHMS if key in keys ]
+
+def fill_missing(artifact, keys):
+    """
+    Lazily computes checksums that were not requested at generation time from the artifact bytes cached
+    on disk by the generator.
+    """
+    checksums = artifact.setdefault("checksums", {})
+    missing = [ key for key in keys if key not in checksums ]
+    if len(missing) == 0:
+        return artifact
+
+    path = lib.get_artifact_path(artifact["url"])
+    if not os.path.exists(path):
+        raise utils.GenericError(f"Cannot compute {', '.join(missing)} for {artifact['url']}, the cached artifact is missing!")
+
+    checksums.update(lib.hash_file(path, missing))
+    return artifact
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import os
+import glob
+import hashlib
+import pickle
+import multiprocessing
+import yaml
+import utils
+from concurrent.futures import ProcessPoolExecutor
+
+# Top-level pkggen.yaml keys that configure pkggen itself instead of declaring a generation level
+RESERVED_KEYS = [ "checksums", "cache", "connections", "include", "watch" ]
+
+# Bumped whenever the layout of compiled configs changes, so that older ones are compiled again
+COMPILED_VERSION = 1
+
+# libyaml is much faster than the pure Python loader, but isn't available in every PyYAML build
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Starting parser processes only pays off once there is a lot of YAML to parse
+PARALLEL_PARSE_THRESHOLD = 1024 * 1024 * 4
+
+def get_config_cache_dir():
+    return os.path.join(utils.get_cache_dir(), "config")
+
+def load_yaml(path):
+    try:
+        with open(path, "r") as stream:
+            return yaml.load(stream, Loader=Loader)
+    except yaml.YAMLError as exception:
+        raise utils.GenericError(f"YAML parsing error in {path}: {exception}")
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def resolve_includes(path, data):
+    """
+    Returns the files included by a config file. Patterns are relative to the including file and may
+    contain wildcards, which are expanded in sorted order.
+    """
+    patterns = data.get("include") or []
+    if type(patterns) != list:
+        patterns = [ patterns ]
+
+    includes = {}
+    for pattern in patterns:
+        pattern = os.path.join(os.path.dirname(path), str(pattern))
+        files = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [ pattern ]
+        if len(files) == 0 and not glob.has_magic(pattern):
+            raise utils.GenericError(f"Couldn't find the included config file {pattern}!")
+        includes[pattern] = [ os.path.abspath(file) for file in files ]
+    return includes
+
+class CompiledConfig:
+    """
+    A validated pkggen.yaml together with every file it includes. Generation levels with the same name in
+    several files are merged, and every package can be looked up by name without scanning the levels.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.settings = {}
+        self.levels = {}
+        self.index = {}
+        self.stamps = {}
+        self.includes = {}
+
+    def add_file(self, path, data):
+        data = data if data != None else {}
+        if type(data) != dict:
+            raise utils.GenericError(f"{path} must contain a mapping of generation levels!")
+
+        for key, generation_level in data.items():
+            if key == "include":
+                continue
+            if key in RESERVED_KEYS:
+                if path != self.path:
+                    raise utils.GenericError(f"The \"{key}\" key in {path} can only be set in the main pkggen.yaml!")
+                self.settings[key] = generation_level
+                continue
+
+            if type(generation_level) != dict or "generator" not in generation_level or "packages" not in generation_level:
+                raise utils.GenericError("Couldn't find a generator or packages key in the generator metadata!")
+
+            packages = generation_level["packages"] or []
+            if key in self.levels:
+                if self.levels[key]["generator"] != generation_level["generator"]:
+                    raise utils.GenericError(f"The generation level \"{key}\" uses different generators in {path} and another config file!")
+                self.levels[key]["packages"] += packages
+            else:
+                self.levels[key] = dict(generation_level, packages=list(packages))
+
+    def build_index(self):
+        for key, generation_level in self.levels.items():
+            for position, package in enumerate(generation_level["packages"]):
+                if type(package) != dict:
+                    raise utils.GenericError(f"Packages of the generation level \"{key}\" must be mappings!")
+                self.index.setdefault(package.get("name"), []).append((key, position))
+
+    def get_packages(self, key, names=None):
+        """
+        Returns the packages of a generation level, optionally only the ones with the given names, in the
+        order of the config
+        """
+        packages = self.levels[key]["packages"]
+        if names == None:
+            return packages
+        positions = sorted(position for name in set(names) for level, position in self.index.get(name, []) if level == key)
+        return [ packages[position] for position in positions ]
+
+    def is_fresh(self):
+        try:
+            if any(get_stamp(path) != stamp for path, stamp in self.stamps.items()):
+                return False
+        except OSError:
+            return False
+        # A new file matching a wildcard include changes the config without touching any known file
+        for pattern, files in self.includes.items():
+            if glob.has_magic(pattern) and [ os.path.abspath(file) for file in sorted(glob.glob(pattern, recursive=True)) ] != files:
+                return False
+        return True
+
+def load_files(paths):
+    cpus = os.cpu_count() or 1
+    if len(paths) == 1 or cpus == 1 or sum(os.path.getsize(path) for path in paths) < PARALLEL_PARSE_THRESHOLD:
+        return [ load_yaml(path) for path in paths ]
+
+    # Parsing holds the GIL, so large includes are parsed in separate processes. They are spawned because
+    # the driver may already be running threads
+    with ProcessPoolExecutor(max_workers=min(len(paths), cpus), mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(executor.map(load_yaml, paths))
+
+def compile_config(path):
+    """
+    Parses pkggen.yaml and all of its includes, one level of includes at a time with every file of a level
+    parsed in parallel
+    """
+    config = CompiledConfig(path)
+    pending = [ config.path ]
+    seen = set()
+    while len(pending) > 0:
+        paths = [ file for file in dict.fromkeys(pending) if file not in seen ]
+        seen.update(paths)
+        pending = []
+        for file, data in zip(paths, load_files(paths)):
+            if file == config.path and data == None:
+                raise utils.GenericError("Couldn't load pkggen.yaml from the default path!")
+            config.stamps[file] = get_stamp(file)
+            config.add_file(file, data)
+            if type(data) == dict:
+                includes = resolve_includes(file, data)
+                config.includes.update(includes)
+                pending += [ include for files in includes.values() for include in files ]
+
+    config.build_index()
+    return config
+
+def get_compiled_path(path):
+    return os.path.join(get_config_cache_dir(), hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest() + ".pickle")
+
+def load_config(path=None, use_cache=True):
+    """
+    Returns the CompiledConfig of pkggen.yaml. The compiled form is cached and reused as long as none of
+    the config files changed, so unchanged configs aren't parsed again.
+    """
+    path = path if path != None else os.path.join(utils.get_run_path(), "pkggen.yaml")
+    if not os.path.exists(path):
+        raise utils.GenericError("Couldn't load pkggen.yaml from the default path!")
+
+    compiled_path = get_compiled_path(path)
+    if use_cache:
+        try:
+            with open(compiled_path, "rb") as stream:
+                version, config = pickle.load(stream)
+            if version == COMPILED_VERSION and config.is_fresh():
+                return config
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+            pass
+
+    config = compile_config(path)
+    if use_cache:
+        os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+        tmp = f"{compiled_path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as stream:
+            pickle.dump((COMPILED_VERSION, config), stream, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, compiled_path)
+    return config
@@ -1,80 +1,267 @@
 #!/usr/bin/env python3
 import os
-import yaml
 import json
 import utils
+import lock
+import checksums
+import cache
+import config
+import scheduler
+import render
+import tracing
 import subprocess
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from workers import WorkerPool
+from progress import Progress
 
-def generate_packages(packages, package_filter, generator):
-    results = []
+def get_generator_env(checksum_keys, no_cache=False, connections=None, scheduler_env=None):
+    env = os.environ.copy()
+    # Long-running callers start the scheduler once and pass its environment for every rebuilt env
+    env.update(scheduler_env if scheduler_env != None else scheduler.start_scheduler())
+    if connections != None:
+        env["PKGGEN_HOST_LIMITS"] = json.dumps(connections)
+    if checksum_keys != None:
+        env["PKGGEN_CHECKSUMS"] = ",".join(checksum_keys)
+    if no_cache:
+        env["PKGGEN_NO_CACHE"] = "1"
+    return env
 
-    def worker_task(package, pkg_filter):
-        if pkg_filter != None and package.get("name") not in pkg_filter:
-            return None
-        
+def prepare_packages(packages, generator, env=None):
+    """
+    Lets the generator resolve data for the whole batch of packages upfront, for example with a single
+    batched API query. Prepared data is passed to each package under the "prefetched" key. Generators that
+    fail to prepare simply resolve every package on their own.
+    """
+    result = subprocess.run(
+        [ sys.executable, generator, "--prepare" ],
+        input=json.dumps(packages),
+        text=True,
+        capture_output=True,
+        env=env
+    )
+
+    try:
+        prepared = json.loads(result.stdout) if result.returncode == 0 else {}
+    except ValueError:
+        prepared = {}
+
+    if type(prepared) != dict:
+        return packages
+    return [ dict(package, prefetched=prepared[package["name"]]) if package.get("name") in prepared else package for package in packages ]
+
+def parse_result(stdout):
+    # Generators write their result to stdout as a single JSON document, logs go to stderr
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        raise utils.GenericError(f"Couldn't parse the generator result: {stdout.strip()[:200]}")
+
+def get_generator_name(generator):
+    return os.path.splitext(os.path.basename(generator))[0]
+
+def interleave(groups):
+    """
+    Merges the packages of every generation level round-robin, so that every generator gets a fair share
+    of the concurrency budget instead of one level running after another
+    """
+    iterators = [ iter([ (generator, package) for package in packages ]) for generator, packages in groups ]
+    while len(iterators) > 0:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+def generate_packages(groups, workers=0, jobs=None, env=None, locked=None, changed_only=False, tracer=None, pools=None, progress=None):
+    tracer = tracer if tracer != None else tracing.Tracer()
+    input_hashes = { package.get("name"): lock.get_input_hash(package) for _, packages in groups for package in packages }
+
+    def prepare(group):
+        generator, packages = group
+        with tracer.span("prepare", generator=get_generator_name(generator), packages=len(packages)):
+            return prepare_packages(packages, generator, env)
+
+    with ThreadPoolExecutor() as executor:
+        groups = list(zip([ generator for generator, _ in groups ], executor.map(prepare, groups)))
+
+    # Long-running callers keep their own worker pools alive between runs, together with the progress
+    # whose pipe the workers write to
+    owned_progress = progress == None
+    if owned_progress:
+        progress = Progress(sum(len(packages) for _, packages in groups), tracer)
+    else:
+        progress.reset(sum(len(packages) for _, packages in groups))
+    env = dict(env if env != None else os.environ, **progress.get_env())
+    pass_fds = progress.get_pass_fds()
+    owned = pools == None
+    if owned:
+        pools = { generator: WorkerPool(generator, workers, env, pass_fds) for generator, _ in groups } if workers > 0 else {}
+
+    def run_generator(generator, package, mode=None):
         js = json.dumps(package)
 
-        result = subprocess.run(
-            [ sys.executable, generator ],
-            input=js,
-            text=True,
-            capture_output = True
-        )
+        # Compared to the generator's own "task" span, this also includes starting the process
+        with tracer.span("generator", package.get("name"), generator=get_generator_name(generator), mode=mode, persistent=generator in pools):
+            if generator in pools:
+                result = pools[generator].run(js, mode)
+            else:
+                result = subprocess.run(
+                    [ sys.executable, generator ] + ([ f"--{mode}" ] if mode != None else []),
+                    input=js,
+                    text=True,
+                    capture_output = True,
+                    env=env,
+                    pass_fds=pass_fds
+                )
 
         if result.returncode != 0:
-            print("Error encountered when running the generator!")
+            print("Error encountered when running the generator!", file=sys.stderr)
 
-            print("Failed generator stdout: ")
-            print(result.stdout)
+            print("Failed generator stdout: ", file=sys.stderr)
+            print(result.stdout, file=sys.stderr)
 
-            print("Failed generator stderr: ")
-            print(result.stderr)
+            print("Failed generator stderr: ", file=sys.stderr)
+            print(result.stderr, file=sys.stderr)
 
             raise utils.GenericError("Errors encountered when running the generator!")
 
         return result.stdout
 
-    with ThreadPoolExecutor() as executor:
-        results = list(executor.map(lambda x: worker_task(x, package_filter), packages))
-    
-    return [res for res in results if res is not None] 
+    def worker_task(generator, package, submitted):
+        name = package.get("name")
+        tracer.add_span("queued", submitted, time.time(), name)
+        generator_name = get_generator_name(generator)
+        entry = locked.get(name) if locked != None else None
 
-def generate(package_filter=None):
-    utils.create_secrets_file()
-    generators_path = utils.get_generators_path()
-    generator_files = os.path.join(generators_path, "generation")
-    generators = []
+        # Checking upstream is cheap compared to downloading and hashing every artifact again
+        if changed_only and entry != None and entry.get("input") == input_hashes[name]:
+            upstream = parse_result(run_generator(generator, package, "probe"))
+            if lock.is_up_to_date(entry, generator_name, input_hashes[name], upstream):
+                return entry["result"]
 
+        result = parse_result(run_generator(generator, package))
+        if locked != None and result != None:
+            locked[name] = {
+                "generator": generator_name,
+                "input": input_hashes[name],
+                "upstream": lock.get_upstream(result),
+                "result": result,
+            }
+        return result
+
+    if jobs == None and workers > 0:
+        jobs = workers * len(groups)
+
+    # Records are yielded as soon as their package finishes, so that consumers don't have to wait for the
+    # slowest package of the run
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = { executor.submit(worker_task, generator, package, time.time()): (generator, package) for generator, package in interleave(groups) }
+        for future in as_completed(futures):
+            generator, package = futures[future]
+            record = { "name": package.get("name"), "generator": get_generator_name(generator) }
+            try:
+                record["result"] = future.result()
+            except utils.GenericError as e:
+                record["error"] = e.args[0]
+            progress.package_done(record["name"])
+            yield record
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if owned:
+            for pool in pools.values():
+                pool.close()
+        if owned_progress:
+            progress.close()
+
+def get_groups(pkggen, generators, generator_files, package_filter):
+    groups = []
+    # Filtered packages are looked up in the index of the compiled config, other levels aren't touched
+    keys = pkggen.levels.keys() if package_filter == None else dict.fromkeys(key for name in package_filter for key, _ in pkggen.index.get(name, []))
+    for key in keys:
+        generation_level = pkggen.levels[key]
+        packages = pkggen.get_packages(key, package_filter)
+
+        if not packages:
+            continue
+
+        found_generator = False
+        generator = ""
+        for gen in generators:
+            if gen == generation_level["generator"] + ".py":
+                generator = gen
+                found_generator = True
+                break
+
+        if not found_generator:
+            raise utils.GenericError("Couldn't find template generator!")
+
+        groups.append((os.path.join(generator_files, generator), packages))
+    return groups
+
+def get_generators(generator_files):
+    generators = []
     for entry in os.scandir(generator_files):
         if entry.is_file() and entry.name != "lib.py":
             generators.append(entry.name)
+    return generators
 
+def generate(package_filter=None, workers=0, no_cache=False, changed_only=False, jobs=None, output=None, trace=None):
+    utils.create_secrets_file()
+    generators_path = utils.get_generators_path()
+    generator_files = os.path.join(generators_path, "generation")
+    generators = get_generators(generator_files)
+
+    pkggen = config.load_config()
+    groups = get_groups(pkggen, generators, generator_files, package_filter)
+    cache.evict(pkggen.settings.get("cache"))
+    tracer = tracing.Tracer(trace != None)
+    env = get_generator_env(checksums.get_checksum_keys(pkggen.settings), no_cache, pkggen.settings.get("connections"))
+    env.update(tracer.get_env())
+    locked = lock.load_lock()
+    packages = { package.get("name"): package for _, group in groups for package in group }
 
-    pkggen = utils.get_pkggen_config()
-    if pkggen != None:
-        for key, generation_level in pkggen.items():
-            if "generator" in generation_level and "packages" in generation_level:
-                packages = generation_level["packages"]
-                
-                if not packages:
-                    continue
-
-                found_generator = False
-                generator = ""
-                for gen in generators:
-                    if gen == generation_level["generator"] + ".py":
-                        generator = gen
-                        found_generator = True
-                        break
-                        
-                # TODO: Pass ready data
-                if found_generator:
-                    return generate_packages(packages, package_filter, os.path.join(generator_files, generator))
-
-                raise utils.GenericError("Couldn't find template generator!")
+    # Templates are rendered while the remaining packages are still being generated
+    renderer = render.Renderer(output, jobs, tracer)
+    failed = []
+    render_failed = []
+    try:
+        for record in generate_packages(groups, workers, jobs, env, locked, changed_only, tracer):
+            if "error" in record:
+                failed.append(record["name"])
             else:
-                raise utils.GenericError("Couldn't find a generator or packages key in the generator metadata!")
+                renderer.submit(packages[record["name"]], record["result"])
+            yield record
+    finally:
+        render_failed = renderer.close()
+        lock.save_lock({ name: entry for name, entry in locked.items() if name in pkggen.index })
+
+        if trace != None:
+            tracer.write(trace)
+            tracer.print_summary()
+
+    if len(failed) > 0:
+        raise utils.GenericError(f"Errors encountered when running the generator for: {', '.join(str(name) for name in failed)}")
+    if len(render_failed) > 0:
+        raise utils.GenericError(f"Errors encountered when rendering: {', '.join(render_failed)}")
+
+def write_records(records, output=None):
+    """
+    Writes one NDJSON record per package as soon as it is generated, either to packages.ndjson inside the
+    output directory or to stdout
+    """
+    if output != None:
+        os.makedirs(output, exist_ok=True)
+        stream = open(os.path.join(output, "packages.ndjson"), "w")
     else:
-        raise utils.GenericError("Couldn't load pkggen.yaml from the default path!")
+        stream = sys.stdout
+
+    try:
+        for record in records:
+            stream.write(json.dumps(record) + "\n")
+            stream.flush()
+    finally:
+        if stream != sys.stdout:
+            stream.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import utils
+
+LOCK_FILE = "pkggen.lock"
+LOCK_VERSION = 1
+
+def get_lock_path():
+    return os.path.join(utils.get_run_path(), LOCK_FILE)
+
+def load_lock():
+    """
+    Loads the packages recorded in pkggen.lock. Every entry stores the generator, a hash of the package's
+    configuration, a fingerprint of the resolved upstream version and artifacts, and the generator's
+    result including artifact sizes and checksums.
+    """
+    try:
+        with open(get_lock_path(), "r") as stream:
+            lock = json.load(stream)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        raise utils.GenericError(f"Couldn't parse {LOCK_FILE}! Delete it to regenerate every package.")
+
+    if lock.get("version") != LOCK_VERSION:
+        return {}
+    return lock.get("packages", {})
+
+def save_lock(packages):
+    path = get_lock_path()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as stream:
+        json.dump({ "version": LOCK_VERSION, "packages": dict(sorted(packages.items())) }, stream, indent=4)
+        stream.write("\n")
+    os.replace(tmp, path)
+
+def get_input_hash(package):
+    return hashlib.sha256(json.dumps(package, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_upstream(result):
+    # Same shape as the fingerprint returned by the generators' probe mode
+    artifacts = result.get("tarball-urls", [])
+    return {
+        "version": result.get("version"),
+        "urls": [ artifact["url"] for artifact in artifacts ],
+        "artifacts": [
+            { "url": artifact["url"], "etag": artifact.get("etag"), "last-modified": artifact.get("last-modified"), "size": artifact.get("size", 0) }
+            for artifact in artifacts
+        ],
+    }
+
+def is_up_to_date(entry, generator, input_hash, upstream):
+    # Artifacts are only compared for generators whose probes report them. The URLs of GitHub artifacts
+    # already change with every new version
+    if entry == None or upstream == None:
+        return False
+    recorded = entry.get("upstream") or {}
+    keys = [ "version", "urls" ] + ([ "artifacts" ] if "artifacts" in upstream else [])
+    return (
+        entry.get("generator") == generator
+        and entry.get("input") == input_hash
+        and all(recorded.get(key) == upstream.get(key) for key in keys)
+    )
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import threading
+from tqdm import tqdm
+
+class Progress:
+    """
+    Collects the progress events generators write to a shared pipe and shows them as a single progress bar
+    for the whole run. The write end of the pipe is passed to every generator through pass_fds, which is
+    only supported on POSIX systems. On other systems only finished packages are counted.
+    """
+    def __init__(self, total, tracer=None):
+        self.tracer = tracer
+        self.lock = threading.Lock()
+        self.running = {}
+        self.downloads = {}
+        self.waiting = 0
+        self.bar = tqdm(total=total, unit="pkg", desc="Generating", file=sys.stderr, disable=None)
+
+        self.read_fd = None
+        self.write_fd = None
+        self.thread = None
+        if os.name == "posix":
+            self.read_fd, self.write_fd = os.pipe()
+            self.thread = threading.Thread(target=self.read_events, daemon=True)
+            self.thread.start()
+
+    def get_env(self):
+        return { "PKGGEN_PROGRESS_FD": str(self.write_fd) } if self.write_fd != None else {}
+
+    def get_pass_fds(self):
+        return (self.write_fd, ) if self.write_fd != None else ()
+
+    def read_events(self):
+        with os.fdopen(self.read_fd, "rb") as stream:
+            for line in stream:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                self.handle(event)
+
+    def handle(self, event):
+        if event.get("event") == "span":
+            if self.tracer != None:
+                self.tracer.add(event)
+            return
+
+        with self.lock:
+            package = event.get("package")
+            kind = event.get("event")
+            if kind == "start":
+                self.running[package] = event.get("mode") or "generating"
+            elif kind == "finish":
+                self.running.pop(package, None)
+            elif kind == "download":
+                self.downloads[(package, event.get("url"))] = event.get("bytes", 0)
+                self.running[package] = "downloading"
+            elif kind == "phase":
+                self.running[package] = event.get("phase")
+                if event.get("phase") == "waiting":
+                    self.waiting += 1
+            self.refresh()
+
+    def refresh(self):
+        downloaded = tqdm.format_sizeof(sum(self.downloads.values()), divisor=1024)
+        postfix = f"{len(self.running)} running, {downloaded}B downloaded"
+        if self.waiting > 0:
+            postfix += f", {self.waiting} rate limit waits"
+        self.bar.set_postfix_str(postfix, refresh=False)
+        # Redraws are rate limited by tqdm
+        self.bar.update(0)
+
+    def reset(self, total):
+        # Long-running callers keep one progress for their workers and start it over for every run
+        with self.lock:
+            self.running = {}
+            self.downloads = {}
+            self.waiting = 0
+            self.bar.reset(total=total)
+
+    def package_done(self, name):
+        with self.lock:
+            self.running.pop(name, None)
+            self.bar.update(1)
+            self.refresh()
+
+    def close(self):
+        # Every generator holding the write end has exited at this point, so the reader sees the end of
+        # the pipe once the driver's copy is closed
+        if self.write_fd != None:
+            os.close(self.write_fd)
+            self.write_fd = None
+            self.thread.join()
+        self.bar.close()
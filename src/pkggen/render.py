@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import sys
+import multiprocessing
+import time
+import utils
+import checksums
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateError
+
+DEFAULT_OUTPUT = "pkggen-build"
+
+environment = None
+
+def get_template_cache_dir():
+    return os.path.join(utils.get_cache_dir(), "templates")
+
+def init_worker(run_path):
+    # Every render process compiles a template at most once. Compiled templates are also stored on disk,
+    # so later runs and the other processes only load the bytecode
+    global environment
+    cache_dir = get_template_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    environment = Environment(
+        loader=FileSystemLoader(run_path),
+        bytecode_cache=FileSystemBytecodeCache(cache_dir),
+        keep_trailing_newline=True,
+        auto_reload=True
+    )
+
+def write_if_changed(path, content, mode_source):
+    data = content.encode("utf-8")
+    try:
+        with open(path, "rb") as stream:
+            if stream.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as stream:
+        stream.write(data)
+    shutil.copymode(mode_source, tmp)
+    os.replace(tmp, path)
+    return True
+
+def render_package(run_path, distribution, pkgname, context, output):
+    """
+    Renders every template in <run path>/<distribution>/<pkgname> into the output directory, keeping the
+    directory structure. Returns the number of files that were written, unchanged files are left alone.
+    """
+    template_dir = os.path.join(run_path, distribution, pkgname)
+    templates = []
+    for root, _, files in os.walk(template_dir):
+        for file in files:
+            templates.append(os.path.relpath(os.path.join(root, file), template_dir))
+
+    # Checksums that weren't computed during generation are filled in from the cached artifacts
+    keys = set()
+    for template in templates:
+        with open(os.path.join(template_dir, template), "r", errors="ignore") as stream:
+            keys.update(checksums.CHECKSUM_REGEX.findall(stream.read()))
+    if len(keys) > 0:
+        for artifact in context.get("tarball-urls", []):
+            checksums.fill_missing(artifact, [ key for key in checksums.HASH_ALGORITHMS if key in keys ])
+
+    written = 0
+    for template in templates:
+        name = "/".join([ distribution, pkgname ] + template.split(os.sep))
+        try:
+            content = environment.get_template(name).render(context)
+        except TemplateError as e:
+            raise utils.GenericError(f"Couldn't render template {name}: {e}")
+
+        if write_if_changed(os.path.join(output, template), content, os.path.join(template_dir, template)):
+            written += 1
+    return written
+
+class Renderer:
+    """
+    Renders the distribution templates of packages as their generator results arrive. Every package and
+    distribution pair is rendered in a separate process.
+    """
+    def __init__(self, output=None, jobs=None, tracer=None):
+        self.tracer = tracer
+        self.run_path = utils.get_run_path()
+        self.output = output if output != None else os.path.join(self.run_path, DEFAULT_OUTPUT)
+        self.jobs = jobs
+        self.executor = None
+        self.futures = {}
+
+        self.distributions = []
+        for distribution in utils.load_distributions():
+            name = utils.get_distribution_name(distribution)
+            if os.path.isdir(os.path.join(self.run_path, name)):
+                self.distributions.append(name)
+
+    def submit(self, package, result):
+        name = package.get("name")
+        context = dict(package, **(result if result != None else {}), pkgname=name)
+        # Keys such as "tarball-urls" aren't valid Jinja identifiers, so they're also available as "tarball_urls"
+        context.update({ key.replace("-", "_"): value for key, value in context.items() if "-" in key })
+
+        for distribution in self.distributions:
+            if not os.path.isdir(os.path.join(self.run_path, distribution, name)):
+                continue
+
+            if self.executor == None:
+                # Generation threads are still running, so render processes are spawned instead of forked
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.run_path, )
+                )
+            future = self.executor.submit(
+                render_package,
+                self.run_path,
+                distribution,
+                name,
+                dict(context, distribution=distribution),
+                os.path.join(self.output, distribution, name)
+            )
+            self.futures[future] = (distribution, name)
+            if self.tracer != None:
+                start = time.time()
+                future.add_done_callback(lambda _, start=start, distribution=distribution: self.tracer.add_span("render", start, time.time(), name, distribution=distribution))
+
+    def close(self):
+        """
+        Waits for every submitted render and returns the "distribution/pkgname" pairs that failed
+        """
+        failed = []
+        if self.executor == None:
+            return failed
+
+        try:
+            for future in as_completed(self.futures):
+                distribution, name = self.futures[future]
+                try:
+                    future.result()
+                except (utils.GenericError, OSError, ValueError) as e:
+                    print(f"Error encountered when rendering {name} for {distribution}: {e}", file=sys.stderr)
+                    failed.append(f"{distribution}/{name}")
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        return failed
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import os
+import secrets
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+# Once fewer than this fraction of a quota is left, the remaining requests are spread evenly until the
+# quota resets instead of being sent as fast as possible
+SPREAD_THRESHOLD = 0.1
+
+# Generators waiting for an artifact that another generator fetches check this often whether it's still alive
+ARTIFACT_WAIT_INTERVAL = 1.0
+
+class Bucket:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_time = 0.0
+        self.paused_until = 0.0
+
+class RateLimiter:
+    """
+    A token bucket per host and API token that is shared by every generator process of a run. Generators
+    reserve a request slot before sending a request and report the rate limit headers of the response
+    back, so that the remaining quota is known to all of them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def get_bucket(self, host, identity):
+        key = (host, identity)
+        if key not in self.buckets:
+            self.buckets[key] = Bucket()
+        return self.buckets[key]
+
+    def acquire(self, host, identity):
+        """
+        Reserves a request slot and returns the number of seconds the caller needs to wait before sending
+        the request
+        """
+        with self.lock:
+            bucket = self.get_bucket(host, identity)
+            now = time.time()
+            start = max(now, bucket.next_time, bucket.paused_until)
+
+            if bucket.reset != None and start >= bucket.reset:
+                # The quota has been reset, the next response reports the new one
+                bucket.remaining = None
+                bucket.reset = None
+
+            if bucket.remaining != None:
+                if bucket.remaining <= 0:
+                    # Every request waits for the reset, not only the one that found the quota exhausted
+                    bucket.paused_until = max(bucket.paused_until, bucket.reset)
+                    start = max(start, bucket.reset)
+                    bucket.remaining = None
+                    bucket.reset = None
+                else:
+                    if bucket.limit != None and bucket.remaining <= bucket.limit * SPREAD_THRESHOLD:
+                        bucket.next_time = start + (bucket.reset - start) / bucket.remaining
+                    bucket.remaining -= 1
+
+            return start - now
+
+    def update(self, host, identity, limit, remaining, reset, retry_after):
+        with self.lock:
+            bucket = self.get_bucket(host, identity)
+            if remaining != None and reset != None:
+                bucket.limit = limit
+                bucket.remaining = remaining
+                bucket.reset = reset
+            if retry_after != None:
+                bucket.paused_until = max(bucket.paused_until, time.time() + retry_after)
+
+def is_process_alive(pid):
+    # Signal 0 only checks whether the process exists, on Windows it would interrupt it instead
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class ArtifactCoordinator:
+    """
+    Merges the downloads of the same artifact by different packages of a run. The first generator that
+    claims a URL fetches and hashes it, every other generator waits for its result instead of downloading
+    the artifact again.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.results = {}
+        self.fetching = {}
+
+    def claim(self, url, keys, pid):
+        """
+        Returns the shared result for the URL once it has all requested checksums. Returns None when the
+        caller has to fetch the artifact itself and report the outcome with complete().
+        """
+        with self.condition:
+            while True:
+                result = self.results.get(url)
+                if result != None and all(key in result["checksums"] for key in keys):
+                    return result
+
+                # A generator that crashed while fetching never completes its claim
+                owner = self.fetching.get(url)
+                if owner == None or not is_process_alive(owner):
+                    self.fetching[url] = pid
+                    return None
+                self.condition.wait(ARTIFACT_WAIT_INTERVAL)
+
+    def complete(self, url, result):
+        """
+        Shares the result of a claimed URL. A result of None means the fetch failed, in which case the next
+        waiting generator tries on its own.
+        """
+        with self.condition:
+            self.fetching.pop(url, None)
+            if result != None:
+                if url in self.results:
+                    result = dict(result, checksums=dict(self.results[url]["checksums"], **result["checksums"]))
+                self.results[url] = result
+            self.condition.notify_all()
+
+    def clear(self):
+        # Long-running processes forget shared results between runs, artifacts may have changed since
+        with self.condition:
+            self.results = {}
+
+class SchedulerManager(BaseManager):
+    pass
+
+def start_scheduler(artifacts=None):
+    """
+    Serves a RateLimiter and an ArtifactCoordinator to generator processes from a background thread.
+    Returns the environment variables generators need to connect to them.
+    """
+    limiter = RateLimiter()
+    artifacts = artifacts if artifacts != None else ArtifactCoordinator()
+    authkey = secrets.token_bytes(32)
+
+    SchedulerManager.register("get_scheduler", callable=lambda: limiter)
+    SchedulerManager.register("get_artifacts", callable=lambda: artifacts)
+    manager = SchedulerManager(address=("127.0.0.1", 0), authkey=authkey)
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    host, port = server.address
+    return {
+        "PKGGEN_SCHEDULER_ADDRESS": f"{host}:{port}",
+        "PKGGEN_SCHEDULER_AUTHKEY": authkey.hex(),
+    }
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import hashlib
+import hmac
+import json
+import re
+import sys
+import threading
+import utils
+import watch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_PATH = "/webhook"
+
+# GitHub doesn't deliver payloads larger than this
+MAX_PAYLOAD_SIZE = 1024 * 1024 * 25
+
+# The queries of GitHub generator packages that an event can change
+EVENT_QUERIES = {
+    "release": [ "releases", "tags" ],
+    "tag": [ "releases", "tags" ],
+    "branch": [ "commits" ],
+}
+
+GITHUB_URL_REGEX = re.compile(r"^https?://github\.com/([^/]+)/([^/]+)/", re.IGNORECASE)
+
+def verify_signature(secret, body, signature):
+    if signature == None:
+        return False
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+def normalise_query(query):
+    return { "release": "releases", "tag": "tags", "commit": "commits" }.get(query, query)
+
+def get_repository_index(pkggen):
+    """
+    Maps "owner/repo" to the packages that depend on the repository, together with the GitHub query they
+    use. Packages of the URL generator that download from github.com are listed with a query of None.
+    """
+    index = {}
+    for generation_level in pkggen.levels.values():
+        for package in generation_level["packages"]:
+            if type(package.get("github")) == dict:
+                github = package["github"]
+                repository = f"{github.get('user')}/{github.get('repo')}".lower()
+                index.setdefault(repository, []).append((package.get("name"), normalise_query(github.get("query"))))
+            elif type(package.get("url-generator")) == dict:
+                match = GITHUB_URL_REGEX.match(str(package["url-generator"].get("url", "")))
+                if match != None:
+                    index.setdefault(f"{match.group(1)}/{match.group(2)}".lower(), []).append((package.get("name"), None))
+    return index
+
+def get_event_kind(event, payload):
+    if event == "release":
+        return "release"
+    if event == "create":
+        return payload.get("ref_type") if payload.get("ref_type") in [ "tag", "branch" ] else None
+    if event == "push":
+        ref = payload.get("ref", "")
+        if ref.startswith("refs/tags/"):
+            return "tag"
+        if ref.startswith("refs/heads/"):
+            return "branch"
+    return None
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, watcher, secret, path=DEFAULT_PATH):
+        super().__init__(address, WebhookHandler)
+        self.watcher = watcher
+        self.secret = secret
+        self.webhook_path = path
+        self.index_lock = threading.Lock()
+        self.indexed = None
+        self.index = {}
+
+    def get_packages(self, event, payload):
+        """
+        Returns the names of the packages that may have been changed by a webhook event
+        """
+        kind = get_event_kind(event, payload)
+        repository = payload.get("repository") or {}
+        if kind == None or type(repository.get("full_name")) != str:
+            return []
+
+        # The index is built again whenever the watcher loads a changed pkggen.yaml
+        pkggen = self.watcher.pkggen
+        with self.index_lock:
+            if pkggen is not self.indexed:
+                self.index = get_repository_index(pkggen)
+                self.indexed = pkggen
+            packages = self.index.get(repository["full_name"].lower(), [])
+
+        queries = EVENT_QUERIES[kind]
+        return [ name for name, query in packages if query in queries or (query == None and kind != "branch") ]
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print(f"Webhook: {format % args}", file=sys.stderr)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != self.server.webhook_path:
+            return self.send_json({ "message": "Not Found" }, 404)
+
+        # The body is read before it can be verified, so its size must be known and bounded up front
+        try:
+            length = int(self.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self.send_json({ "message": "Invalid Content-Length" }, 400)
+        if length > MAX_PAYLOAD_SIZE:
+            self.close_connection = True
+            return self.send_json({ "message": "Payload too large" }, 413)
+        body = self.rfile.read(length)
+
+        if not verify_signature(self.server.secret, body, self.headers.get("X-Hub-Signature-256")):
+            return self.send_json({ "message": "Invalid signature" }, 401)
+
+        event = self.headers.get("X-GitHub-Event")
+        if event == "ping":
+            return self.send_json({ "message": "pong" })
+        if self.server.watcher.pkggen == None:
+            return self.send_json({ "message": "Not ready" }, 503)
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return self.send_json({ "message": "Invalid JSON payload" }, 400)
+        if type(payload) != dict:
+            return self.send_json({ "message": "Invalid JSON payload" }, 400)
+
+        names = self.server.get_packages(event, payload)
+        if len(names) > 0:
+            self.server.watcher.trigger(names)
+        self.send_json({ "queued": names }, 202 if len(names) > 0 else 200)
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, path=DEFAULT_PATH, debounce=watch.DEFAULT_DEBOUNCE, workers=1, jobs=None, output=None, interval=None, jitter=None):
+    """
+    Receives GitHub webhooks and regenerates the packages of the repository that sent them. Webhooks are
+    verified with the "webhook_secret" from secrets.yaml. The packages are also polled like with
+    "pkggen watch", which catches up on events that were missed while the server wasn't running.
+    """
+    secret = utils.load_secrets().get("webhook_secret")
+    if not secret:
+        raise utils.GenericError(f"No webhook_secret found in {utils.create_secrets_file()}! Set it to the secret of your GitHub webhooks.")
+
+    watcher = watch.Watcher(workers, jobs, output, interval, jitter, debounce)
+    server = WebhookServer((host, port), watcher, str(secret), path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Listening for webhooks on http://{host}:{server.server_address[1]}{path}", file=sys.stderr)
+
+    try:
+        watcher.run()
+    finally:
+        server.shutdown()
+        server.server_close()
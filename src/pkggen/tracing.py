@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+SUMMARY_ROWS = 10
+
+class Tracer:
+    """
+    Collects timing spans of a run, both from the driver and from the generators, which send theirs over
+    the progress pipe. Spans are exported in the Chrome trace event format, which can be opened in
+    chrome://tracing or https://ui.perfetto.dev.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def get_env(self):
+        return { "PKGGEN_TRACE": "1" } if self.enabled else {}
+
+    def add(self, event):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.spans.append(event)
+
+    def add_span(self, name, start, end, package=None, **args):
+        self.add({
+            "name": name,
+            "package": package,
+            "start": start,
+            "end": end,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+    @contextmanager
+    def span(self, name, package=None, **args):
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.add_span(name, start, time.time(), package, **args)
+
+    def write(self, path):
+        if len(self.spans) == 0:
+            return
+
+        origin = min(span["start"] for span in self.spans)
+        driver = os.getpid()
+        events = [ { "name": "process_name", "ph": "M", "pid": driver, "args": { "name": "pkggen" } } ]
+        for pid in sorted(set(span["pid"] for span in self.spans if span["pid"] != driver)):
+            events.append({ "name": "process_name", "ph": "M", "pid": pid, "args": { "name": f"generator {pid}" } })
+
+        for span in self.spans:
+            events.append({
+                "name": span["name"],
+                "cat": "driver" if span["pid"] == driver else "generator",
+                "ph": "X",
+                "ts": (span["start"] - origin) * 1000000,
+                "dur": (span["end"] - span["start"]) * 1000000,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": dict(span["args"], package=span["package"]),
+            })
+
+        with open(path, "w") as stream:
+            json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, stream)
+
+    def print_summary(self, file=sys.stderr):
+        """
+        Prints the packages that took the longest and the total time spent in every phase
+        """
+        if len(self.spans) == 0:
+            return
+
+        packages = {}
+        phases = {}
+        for span in self.spans:
+            duration = span["end"] - span["start"]
+            if span["name"] == "generator":
+                packages[span["package"]] = packages.get(span["package"], 0.0) + duration
+
+            phase = phases.setdefault(span["name"], [ 0, 0.0, 0.0 ])
+            phase[0] += 1
+            phase[1] += duration
+            phase[2] = max(phase[2], duration)
+
+        slowest = sorted(packages.items(), key=lambda x: x[1], reverse=True)[:SUMMARY_ROWS]
+        width = max([ len(str(name)) for name, _ in slowest ] + [ len("Package") ])
+        print(f"{'Package'.ljust(width)}  {'Seconds':>10}", file=file)
+        for name, duration in slowest:
+            print(f"{str(name).ljust(width)}  {duration:10.3f}", file=file)
+
+        print(file=file)
+        width = max(len(name) for name in phases)
+        print(f"{'Phase'.ljust(width)}  {'Count':>7}  {'Total s':>10}  {'Mean ms':>10}  {'Max ms':>10}", file=file)
+        for name, (count, total, longest) in sorted(phases.items(), key=lambda x: x[1][1], reverse=True):
+            print(f"{name.ljust(width)}  {count:7d}  {total:10.3f}  {total / count * 1000:10.1f}  {longest * 1000:10.1f}", file=file)
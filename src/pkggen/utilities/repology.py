@@ -1,124 +1,243 @@
 #!/usr/bin/env python3
 import sys
 import os
-import yaml
 import json
-import argparse
+import time
+import hashlib
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from packaging.version import parse as parse_version
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import utils
 
-def query_repology(package, is_raw, include_outdated):
-    generators_path = utils.get_generators_path()
-    with open(os.path.join(generators_path, "distributions", "distributions.yaml"), "r") as stream:
+REPOLOGY_API = os.getenv("PKGGEN_REPOLOGY_API", "https://repology.org/api/v1/project")
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.5 Safari/605.1.15',
+}
+
+# Repology asks API clients to send at most one request per second
+REQUEST_INTERVAL = 1.0
+BULK_WORKERS = 4
+DEFAULT_MAX_AGE = 60 * 60 * 24
+
+class RequestSpacer:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+spacer = RequestSpacer(REQUEST_INTERVAL)
+
+def get_response_cache_path(package):
+    return os.path.join(utils.get_cache_dir(), "repology", hashlib.sha256(package.encode("utf-8")).hexdigest() + ".json")
+
+def fetch_project(package, max_age=DEFAULT_MAX_AGE):
+    """
+    Returns the response code and the decoded body of the repology project request for a package. Responses
+    are cached on disk for max_age seconds.
+    """
+    path = get_response_cache_path(package)
+    if max_age > 0:
         try:
-            distributions = yaml.safe_load(stream)["distributions"]
-
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.5 Safari/605.1.15',
-            }
-            output = []
-
-            response = requests.get(f"https://repology.org/api/v1/project/{package}", headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                for item in data:
-                    for distribution in distributions:
-                        b_skip = False
-                        for release in distribution["rp-names"]:
-                            if item["repo"] == release and (
-                                    ("binname" in item and item["binname"] == package) or 
-                                    ("srcname" in item and item["srcname"] == package) or 
-                                    ("visiblename" in item and item["visiblename"] == package)
-                                ):
-
-                                output.append({
-                                    "distribution":         release,
-                                    "distribution_type":    "supported",
-                                    "srcname":              item["srcname"] if "srcname" in item else "",
-                                    "binname":              item["binname"] if "binname" in item else "",
-                                    "repository":           item["subrepo"] if "subrepo" in item else "",
-                                    "version":              item["version"],
-                                    "status":               item["status"],
-                                    "summary":              item["summary"],
-                                })
-                                b_skip = True
-                                break
-
-                        if b_skip:
-                            continue
-
-                        if include_outdated:
-                            if "rp-names-wildcards" in distribution:
-                                for release in distribution["rp-names-wildcards"]:
-                                    if release in item["repo"] and (
-                                            ("binname" in item and item["binname"] == package) or 
-                                            ("srcname" in item and item["srcname"] == package) or 
-                                            ("visiblename" in item and item["visiblename"] == package)
-                                        ):
-
-                                        output.append({
-                                            "distribution":         item["repo"],
-                                            "distribution_type":    "discontinued",
-                                            "srcname":              item["srcname"] if "srcname" in item else "None",
-                                            "binname":              item["binname"] if "binname" in item else "None",
-                                            "repository":           item["subrepo"] if "subrepo" in item else "Default",
-                                            "version":              item["version"],
-                                            "status":               item["status"],
-                                            "summary":              item["summary"],
-                                        })
-                
-                output.sort(key=lambda x: parse_version(x["version"]), reverse=True)
-                output.sort(key=lambda x: x["distribution_type"] != "supported")
-                if is_raw:
-                    print(json.dumps(output))
-                    return
-                
-                b_first = True
-                max_width = 0
-
-                def strings_do(f):
-                    for i in output:
-                        lines = [
-                            f"Distribution: {i['distribution']}",
-                            f"Distribution support state: {i['distribution_type']}",
-                            f"Repository: {i['repository']}",
-                            f"Source package name: {i['srcname']}",
-                            f"Binary package name: {i['binname']}",
-                            f"Version: {i['version']}",
-                            f"Status: {i['status']}",
-                            f"Summary: {i['summary']}"
-                        ]
-                        f(lines)
-               
-                def get_max_width(lines):
-                    nonlocal max_width
-                    max_width = max(max_width, max(len(line) for line in lines))
-                
-                def print_with_formatting(lines):
-                    nonlocal b_first
-                    nonlocal max_width
-
-                    if b_first:
-                        print("┏" + "━" * (max_width + 2) + "┓")
-                        b_first = False
-                    else:
-                        print("┣" + "━" * (max_width + 2) + "┫")
-                    
-                    for line in lines:
-                        print(f"┃ {line.ljust(max_width)} ┃")
-
-
-                strings_do(get_max_width)
-                strings_do(print_with_formatting)
-                print("┗" + "━" * (max_width + 2) + "┛")
+            with open(path, "r") as stream:
+                cached = json.load(stream)
+            if cached.get("package") == package and time.time() - cached["fetched"] <= max_age:
+                return cached["status"], cached["body"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    spacer.wait()
+    response = utils.http_get(f"{REPOLOGY_API}/{package}", headers=HEADERS)
+    body = response.json() if response.status_code == 200 else None
+
+    if response.status_code == 200 or response.status_code == 404:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as stream:
+            json.dump({ "package": package, "fetched": time.time(), "status": response.status_code, "body": body }, stream)
+        os.replace(tmp, path)
+    return response.status_code, body
+
+def get_project(package, max_age=DEFAULT_MAX_AGE, database=None, live=False):
+    """
+    Looks a project up in the offline database when one is given, only querying the live API for projects
+    missing from it when live is set
+    """
+    if database != None:
+        data = database.lookup(package)
+        if data != None:
+            return 200, data
+        if not live:
+            return 404, None
+    return fetch_project(package, max_age)
+
+class DistributionIndex:
+    """
+    distributions.yaml compiled for matching repology entries. Exact release names are kept in one set per
+    distribution, and the releases an entry's repository expands to are computed once per repository name,
+    since a project's entries only come from a few hundred repositories.
+    """
+    def __init__(self, distributions):
+        self.releases = [ set(distribution["rp-names"]) for distribution in distributions ]
+        self.wildcards = [ distribution["rp-names-wildcards"] if "rp-names-wildcards" in distribution else [] for distribution in distributions ]
+        self.matches = {}
+
+    def match(self, repo, include_outdated):
+        """
+        Returns the distribution types of the entries a repository produces, in distribution order. An
+        exact release match takes priority over the wildcards of the same distribution, while every
+        matching wildcard produces its own entry.
+        """
+        key = (repo, include_outdated)
+        if key not in self.matches:
+            types = []
+            for releases, wildcards in zip(self.releases, self.wildcards):
+                if repo in releases:
+                    types.append("supported")
+                elif include_outdated:
+                    types += [ "discontinued" for release in wildcards if release in repo ]
+            self.matches[key] = types
+        return self.matches[key]
+
+def match_project(package, data, index, include_outdated):
+    output = []
+    for item in data:
+        if not (
+                ("binname" in item and item["binname"] == package) or
+                ("srcname" in item and item["srcname"] == package) or
+                ("visiblename" in item and item["visiblename"] == package)
+            ):
+            continue
+
+        for distribution_type in index.match(item["repo"], include_outdated):
+            if distribution_type == "supported":
+                output.append({
+                    "distribution":         item["repo"],
+                    "distribution_type":    "supported",
+                    "srcname":              item["srcname"] if "srcname" in item else "",
+                    "binname":              item["binname"] if "binname" in item else "",
+                    "repository":           item["subrepo"] if "subrepo" in item else "",
+                    "version":              item["version"],
+                    "status":               item["status"],
+                    "summary":              item["summary"],
+                })
+            else:
+                output.append({
+                    "distribution":         item["repo"],
+                    "distribution_type":    "discontinued",
+                    "srcname":              item["srcname"] if "srcname" in item else "None",
+                    "binname":              item["binname"] if "binname" in item else "None",
+                    "repository":           item["subrepo"] if "subrepo" in item else "Default",
+                    "version":              item["version"],
+                    "status":               item["status"],
+                    "summary":              item["summary"],
+                })
+
+    # Entries of a project share a handful of versions, so each one is only parsed once
+    versions = { entry["version"]: parse_version(entry["version"]) for entry in output }
+    output.sort(key=lambda x: versions[x["version"]], reverse=True)
+    output.sort(key=lambda x: x["distribution_type"] != "supported")
+    return output
+
+def query_repology(package, is_raw, include_outdated, max_age=DEFAULT_MAX_AGE, database=None, live=False):
+    index = DistributionIndex(utils.load_distributions())
 
+    status, data = get_project(package, max_age, database, live)
+    if status == 200:
+        output = match_project(package, data, index, include_outdated)
+        if is_raw:
+            print(json.dumps(output))
+            return
+
+        b_first = True
+        max_width = 0
+
+        def strings_do(f):
+            for i in output:
+                lines = [
+                    f"Distribution: {i['distribution']}",
+                    f"Distribution support state: {i['distribution_type']}",
+                    f"Repository: {i['repository']}",
+                    f"Source package name: {i['srcname']}",
+                    f"Binary package name: {i['binname']}",
+                    f"Version: {i['version']}",
+                    f"Status: {i['status']}",
+                    f"Summary: {i['summary']}"
+                ]
+                f(lines)
+
+        def get_max_width(lines):
+            nonlocal max_width
+            max_width = max(max_width, max(len(line) for line in lines))
+
+        def print_with_formatting(lines):
+            nonlocal b_first
+            nonlocal max_width
+
+            if b_first:
+                print("┏" + "━" * (max_width + 2) + "┓")
+                b_first = False
             else:
-                if is_raw:
-                    print(f'\\{ "error": "No such dependency", "response_code": {response.status_code} \\}')
-                else:
-                    print("No such dependency! Response code:", response.status_code)
-        except yaml.YAMLError as exception:
-            raise utils.GenericError("YAML parsing error: " + exception)
+                print("┣" + "━" * (max_width + 2) + "┫")
+
+            for line in lines:
+                print(f"┃ {line.ljust(max_width)} ┃")
+
+
+        strings_do(get_max_width)
+        strings_do(print_with_formatting)
+        print("┗" + "━" * (max_width + 2) + "┛")
+
+    else:
+        if is_raw:
+            print(json.dumps({ "error": "No such dependency", "response_code": status }))
+        else:
+            print("No such dependency! Response code:", status)
+
+def read_package_names(packages, file=None):
+    names = list(packages) if packages != None else []
+    if file != None:
+        if file == "-":
+            names += sys.stdin.read().split()
+        else:
+            with open(file, "r") as stream:
+                names += stream.read().split()
+    elif len(names) == 0 and not sys.stdin.isatty():
+        names += sys.stdin.read().split()
+
+    # Keep the first occurrence of every name
+    return list(dict.fromkeys(names))
+
+def query_repology_bulk(packages, include_outdated, max_age=DEFAULT_MAX_AGE, database=None, live=False):
+    """
+    Queries many packages at once and prints a single JSON object that maps every package to its matches,
+    or to an error object when repology doesn't know it. Requests run concurrently, but are spaced
+    according to repology's rate limit.
+    """
+    index = DistributionIndex(utils.load_distributions())
+
+    def query(package):
+        try:
+            status, data = get_project(package, max_age, database, live)
+        except (requests.RequestException, ValueError) as e:
+            return { "error": str(e) }
+
+        if status != 200:
+            return { "error": "No such dependency", "response_code": status }
+        return match_project(package, data, index, include_outdated)
+
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+        results = list(executor.map(query, packages))
+
+    print(json.dumps(dict(zip(packages, results))))
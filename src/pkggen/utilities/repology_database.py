@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import sys
+import os
+import gzip
+import json
+import re
+import sqlite3
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+DATABASE_FILE = "repology.sqlite"
+IMPORT_BATCH_SIZE = 10000
+
+# Dumps are parsed in chunks of this many characters, so that they never have to fit in memory
+DUMP_CHUNK_SIZE = 1024 * 1024
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def get_database_path():
+    return os.path.join(utils.get_cache_dir(), DATABASE_FILE)
+
+def open_dump(path):
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+class DumpReader:
+    """
+    An incremental JSON parser for repology dumps. Only the current chunk of the dump and the project that
+    is being parsed are kept in memory.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.stream.read(DUMP_CHUNK_SIZE)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.eof = chunk == ""
+
+    def peek(self):
+        # Returns the next character that isn't whitespace, or None at the end of the dump
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return None
+            self.fill()
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == None or character not in characters:
+            raise utils.GenericError(f"Couldn't parse the repology dump, expected one of \"{characters}\" but found {repr(character) if character != None else 'the end of the dump'}!")
+        self.position += 1
+        return character
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, self.position = self.decoder.raw_decode(self.buffer, self.position)
+                return value
+            except ValueError as exception:
+                # The value may continue in the next chunk
+                if self.eof:
+                    raise utils.GenericError(f"Couldn't parse the repology dump: {exception}")
+                self.fill()
+
+def read_dump(stream):
+    """
+    Yields (project, entries) pairs from a repology dump. A dump is either a single JSON object in the
+    format of the /api/v1/projects/ endpoint, which maps project names to their entries, or one such
+    object per line, for example when concatenating the pages of an export. Both are parsed as a stream
+    of objects, one project at a time.
+    """
+    reader = DumpReader(stream)
+    while reader.peek() != None:
+        if reader.peek() != "{":
+            raise utils.GenericError("A repology dump must map project names to lists of entries!")
+        reader.expect("{")
+        if reader.peek() == "}":
+            reader.expect("}")
+            continue
+
+        while True:
+            project = reader.read_value()
+            reader.expect(":")
+            entries = reader.read_value()
+            if type(project) != str or type(entries) != list:
+                raise utils.GenericError("A repology dump must map project names to lists of entries!")
+            yield project, entries
+            if reader.expect(",}") == "}":
+                break
+
+def import_dump(path, database=None):
+    """
+    Builds the offline repology index from a dump. The database is written next to its final location
+    and only replaces the previous one once the import succeeded.
+    """
+    database = database if database != None else get_database_path()
+    os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    tmp = f"{database}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    connection = sqlite3.connect(tmp)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE entries (project TEXT NOT NULL, data TEXT NOT NULL)")
+        connection.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+
+        projects = 0
+        rows = []
+        with open_dump(path) as stream:
+            for project, entries in read_dump(stream):
+                projects += 1
+                rows += [ (project, json.dumps(entry)) for entry in entries ]
+                if len(rows) >= IMPORT_BATCH_SIZE:
+                    connection.executemany("INSERT INTO entries VALUES (?, ?)", rows)
+                    rows = []
+        connection.executemany("INSERT INTO entries VALUES (?, ?)", rows)
+
+        # Creating the index after inserting is much faster than maintaining it during the import
+        connection.execute("CREATE INDEX entries_project ON entries (project)")
+        connection.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("source", os.path.abspath(path) if path != "-" else "-"),
+            ("imported", str(time.time())),
+            ("projects", str(projects)),
+        ])
+        connection.commit()
+        connection.close()
+    except BaseException:
+        connection.close()
+        os.remove(tmp)
+        raise
+
+    os.replace(tmp, database)
+    return projects
+
+class RepologyDatabase:
+    """
+    Read-only access to an imported repology dump. Entries are returned in the same order and format as
+    the /api/v1/project/<name> endpoint.
+    """
+    def __init__(self, path=None):
+        self.path = path if path != None else get_database_path()
+        if not os.path.exists(self.path):
+            raise utils.GenericError(f"No repology database found at {self.path}! Import a dump with \"pkggen repology-import\" first.")
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+
+    def lookup(self, project):
+        with self.lock:
+            rows = self.connection.execute("SELECT data FROM entries WHERE project = ? ORDER BY rowid", (project, )).fetchall()
+        return [ json.loads(data) for (data, ) in rows ] if len(rows) > 0 else None
+
+    def close(self):
+        self.connection.close()
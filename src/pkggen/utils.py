@@ -2,6 +2,7 @@
 import os
 import yaml
 import sys
+import importlib
 
 def create_secrets_file():
     if os.name == 'nt':
@@ -16,15 +17,52 @@ def create_secrets_file():
             f.write('')
     return secrets_file
 
+def load_secrets():
+    with open(create_secrets_file(), "r") as stream:
+        result = yaml.safe_load(stream)
+        return result if result != None else {}
+
+def get_cache_dir():
+    if os.name == 'nt':
+        base_dir = os.getenv('LOCALAPPDATA', os.path.expanduser('~\\AppData\\Local'))
+    else:
+        base_dir = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base_dir, 'pkggen')
+
 def get_generators_path():
     return os.getenv("PKGGEN_GENERATORS_PATH", os.getcwd())
 
-def get_pkggen_config():
-    pkggen_path = os.getenv("PKGGEN_RUN_PATH", os.getcwd())
-    pkggen_config = os.path.join(pkggen_path, "pkggen.yaml")
+def get_run_path():
+    return os.getenv("PKGGEN_RUN_PATH", os.getcwd())
+
+def load_distributions():
+    with open(os.path.join(get_generators_path(), "distributions", "distributions.yaml"), "r") as stream:
+        try:
+            return yaml.safe_load(stream)["distributions"]
+        except yaml.YAMLError as exception:
+            raise GenericError("YAML parsing error: " + str(exception))
+
+def get_distribution_name(distribution):
+    for key in distribution:
+        if key != "rp-names" and key != "rp-names-wildcards":
+            return key
+    return None
+
+def get_generator_lib():
+    """
+    Imports lib.py of the generators. The checksum algorithms, the artifact cache and the HTTP connection
+    pools are defined there once and shared with the driver, so that both sides always agree on them.
+    """
+    path = os.path.join(get_generators_path(), "generation")
+    if path not in sys.path:
+        sys.path.append(path)
+    try:
+        return importlib.import_module("lib")
+    except ImportError as exception:
+        raise GenericError(f"Couldn't import lib.py from the generators in {path}: {exception}")
 
-    with open(pkggen_config, "r") as stream:
-        return yaml.safe_load(stream)
+def http_get(url, **kwargs):
+    return get_generator_lib().http_get(url, **kwargs)
 
 class GenericError(Exception):
     def __init__(self, message):
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import random
+import signal
+import threading
+import time
+import utils
+import lock
+import cache
+import checksums
+import config
+import generate
+import render
+import scheduler
+from concurrent.futures import ThreadPoolExecutor
+from workers import WorkerPool
+from progress import Progress
+
+DEFAULT_INTERVAL = 60 * 60
+DEFAULT_JITTER = 0.1
+DEFAULT_MAX_BACKOFF = 60 * 60 * 24
+
+# Packages that become due within this many seconds of each other are polled together
+BATCH_WINDOW = 5
+
+# How often pkggen.yaml is checked for changes while waiting for the next poll
+CONFIG_CHECK_INTERVAL = 60
+
+# Triggered packages are polled once no further trigger arrived for the debounce delay, but never later than
+# this many seconds after the first trigger
+DEFAULT_DEBOUNCE = 2
+MAX_DEBOUNCE_DELAY = 30
+
+class PackageState:
+    def __init__(self, generator, package, interval):
+        self.generator = generator
+        self.package = package
+        self.input_hash = lock.get_input_hash(package)
+        self.interval = interval
+        self.upstream = None
+        self.polled = None
+        self.failures = 0
+        self.next_poll = 0.0
+
+class Watcher:
+    """
+    Keeps the compiled pkggen.yaml, persistent generator workers with their connection pools, and the last
+    known upstream of every package in memory. Every package is probed on its own jittered schedule, and
+    only packages whose upstream changed are generated and rendered again. Configured through the "watch"
+    key in pkggen.yaml, for example:
+
+        watch:
+          interval: "1h"
+          jitter: 0.1
+          max-backoff: "1d"
+
+    Generation levels can poll at their own rate with a "watch-interval" key. Other threads can ask for
+    packages to be polled early with trigger().
+    """
+    def __init__(self, workers=1, jobs=None, output=None, interval=None, jitter=None, debounce=DEFAULT_DEBOUNCE):
+        self.workers = max(workers, 1)
+        self.jobs = jobs
+        self.output = output
+        self.interval_override = interval
+        self.jitter_override = jitter
+        self.debounce = debounce
+
+        self.generator_files = os.path.join(utils.get_generators_path(), "generation")
+        self.artifacts = scheduler.ArtifactCoordinator()
+        self.scheduler_env = scheduler.start_scheduler(self.artifacts)
+        self.progress = Progress(0)
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.triggers = {}
+        self.pkggen = None
+        self.settings = None
+        self.env = None
+        self.pools = {}
+        self.states = {}
+        self.locked = lock.load_lock()
+
+    def load(self):
+        """
+        Loads pkggen.yaml again, keeping the state of every package whose configuration didn't change
+        """
+        self.pkggen = config.load_config()
+        settings = self.pkggen.settings
+        watch_settings = settings.get("watch") or {}
+        interval = cache.parse_age(self.interval_override if self.interval_override != None else watch_settings.get("interval", DEFAULT_INTERVAL))
+        self.jitter = float(self.jitter_override if self.jitter_override != None else watch_settings.get("jitter", DEFAULT_JITTER))
+        self.max_backoff = cache.parse_age(watch_settings.get("max-backoff", DEFAULT_MAX_BACKOFF))
+
+        # Workers inherit their environment, so they're restarted when it changes. The scheduler keeps
+        # running, so that rate limits and shared artifacts carry over
+        env_settings = { key: settings.get(key) for key in [ "checksums", "connections" ] }
+        if env_settings != self.settings:
+            self.close_pools()
+            self.env = generate.get_generator_env(checksums.get_checksum_keys(settings), False, settings.get("connections"), self.scheduler_env)
+            self.env.update(self.progress.get_env())
+            self.settings = env_settings
+
+        states = {}
+        for generator, packages in generate.get_groups(self.pkggen, generate.get_generators(self.generator_files), self.generator_files, None):
+            for package in packages:
+                name = package.get("name")
+                level = self.pkggen.levels[self.pkggen.index[name][0][0]]
+                state = PackageState(generator, package, cache.parse_age(level.get("watch-interval", interval)))
+                previous = self.states.get(name)
+                if previous != None and previous.generator == generator and previous.input_hash == state.input_hash:
+                    previous.interval = state.interval
+                    state = previous
+                states[name] = state
+        self.states = states
+        print(f"Watching {len(self.states)} packages", file=sys.stderr)
+
+    def get_pool(self, generator):
+        if generator not in self.pools:
+            self.pools[generator] = WorkerPool(generator, self.workers, self.env, self.progress.get_pass_fds())
+        return self.pools[generator]
+
+    def close_pools(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+    def trigger(self, names):
+        """
+        Polls the given packages as soon as the triggers for them settle. Repeated triggers for the same
+        package are coalesced into a single poll.
+        """
+        now = time.time()
+        with self.lock:
+            for name in names:
+                first, _ = self.triggers.get(name, (now, now))
+                self.triggers[name] = (first, now)
+        self.wakeup.set()
+
+    def get_trigger_time(self, first, last):
+        return min(first + MAX_DEBOUNCE_DELAY, last + self.debounce)
+
+    def apply_triggers(self):
+        """
+        Makes every package whose triggers settled due right away and returns when the next one settles
+        """
+        now = time.time()
+        next_trigger = None
+        with self.lock:
+            for name, (first, last) in list(self.triggers.items()):
+                trigger_time = self.get_trigger_time(first, last)
+                if trigger_time <= now:
+                    del self.triggers[name]
+                    if name in self.states:
+                        self.states[name].next_poll = now
+                else:
+                    next_trigger = trigger_time if next_trigger == None else min(next_trigger, trigger_time)
+        return next_trigger
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def schedule(self, state, delay):
+        state.next_poll = time.time() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def check(self, state):
+        """
+        Probes the upstream of a package and returns whether it changed since it was last generated
+        """
+        name = state.package.get("name")
+        result = self.get_pool(state.generator).run(json.dumps(state.package), "probe")
+        try:
+            if result.returncode != 0:
+                raise utils.GenericError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"The generator exited with code {result.returncode}")
+            upstream = generate.parse_result(result.stdout)
+        except utils.GenericError as e:
+            # Failing upstreams are polled less and less often until they recover
+            state.failures += 1
+            self.schedule(state, min(state.interval * 2 ** state.failures, self.max_backoff))
+            print(f"Failed to check {name} for updates: {e.args[0]}", file=sys.stderr)
+            return False
+
+        state.failures = 0
+        state.polled = upstream
+        self.schedule(state, state.interval)
+        if state.upstream == None:
+            # The first poll after starting compares against the last run recorded in pkggen.lock
+            changed = not lock.is_up_to_date(self.locked.get(name), generate.get_generator_name(state.generator), state.input_hash, upstream)
+        else:
+            changed = upstream != state.upstream
+
+        if not changed:
+            state.upstream = upstream
+        return changed
+
+    def regenerate(self, changed):
+        groups = {}
+        for state in changed:
+            groups.setdefault(state.generator, []).append(state.package)
+        for generator in groups:
+            self.get_pool(generator)
+
+        # Artifacts that were shared within the previous run may have changed since
+        self.artifacts.clear()
+        renderer = render.Renderer(self.output, self.jobs)
+        try:
+            for record in generate.generate_packages(list(groups.items()), self.workers, self.jobs, self.env, self.locked, pools=self.pools, progress=self.progress):
+                state = self.states[record["name"]]
+                if "error" in record:
+                    print(f"Failed to generate {record['name']}: {record['error']}", file=sys.stderr)
+                else:
+                    # Only packages that were generated successfully count as up to date, the others are
+                    # generated again after their next poll
+                    state.upstream = state.polled
+                    renderer.submit(state.package, record["result"])
+                print(json.dumps(record), flush=True)
+        finally:
+            for failed in renderer.close():
+                print(f"Failed to render {failed}", file=sys.stderr)
+            lock.save_lock({ name: entry for name, entry in self.locked.items() if name in self.pkggen.index })
+
+    def run_cycle(self, due):
+        generators = set(state.generator for state in due)
+        for generator in generators:
+            self.get_pool(generator)
+
+        with ThreadPoolExecutor(max_workers=self.jobs if self.jobs != None else self.workers * len(generators)) as executor:
+            changed = [ state for state, is_changed in zip(due, executor.map(self.check, due)) if is_changed ]
+
+        if len(changed) > 0:
+            print(f"Upstream changed for: {', '.join(state.package.get('name') for state in changed)}", file=sys.stderr)
+            self.regenerate(changed)
+
+    def run(self, once=False):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+
+        self.load()
+        try:
+            while not self.stopped.is_set():
+                if not self.pkggen.is_fresh():
+                    self.load()
+
+                self.wakeup.clear()
+                next_trigger = self.apply_triggers()
+                now = time.time()
+                due = [ state for state in self.states.values() if state.next_poll <= now + BATCH_WINDOW ]
+                if len(due) > 0:
+                    self.run_cycle(due)
+                if once:
+                    break
+
+                next_poll = min((state.next_poll for state in self.states.values()), default=time.time() + CONFIG_CHECK_INTERVAL)
+                if next_trigger != None:
+                    next_poll = min(next_poll, next_trigger)
+                self.wakeup.wait(max(0, min(next_poll - time.time(), CONFIG_CHECK_INTERVAL)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close_pools()
+            self.progress.close()
+
+def watch(workers=1, jobs=None, output=None, interval=None, jitter=None, once=False):
+    utils.create_secrets_file()
+    Watcher(workers, jobs, output, interval, jitter).run(once)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import queue
+import subprocess
+import sys
+import utils
+
+# The frames of the worker protocol are written and read with the generators' own helpers
+lib = utils.get_generator_lib()
+
+class GeneratorWorker:
+    def __init__(self, generator, env=None, pass_fds=()):
+        self.generator = generator
+        self.env = env
+        self.pass_fds = pass_fds
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [ sys.executable, self.generator, "--worker" ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=self.env,
+            pass_fds=self.pass_fds
+        )
+
+    def run(self, js, mode=None):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        try:
+            lib.write_frame(self.process.stdin, { "input": js, "mode": mode })
+            response = lib.read_frame(self.process.stdout)
+        except (BrokenPipeError, OSError, ValueError):
+            response = None
+
+        if response is None:
+            # The worker died while handling this package. Only this package fails, a fresh worker
+            # is started for the next one
+            returncode = self.process.wait()
+            self.process = None
+            return subprocess.CompletedProcess(
+                self.generator,
+                returncode if returncode != 0 else 1,
+                "",
+                f"The generator worker exited unexpectedly with code {returncode}!\n"
+            )
+
+        return subprocess.CompletedProcess(self.generator, response["returncode"], response["stdout"], response["stderr"])
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+class WorkerPool:
+    def __init__(self, generator, size, env=None, pass_fds=()):
+        self.generator = generator
+        self.idle = queue.Queue()
+        self.workers = []
+
+        # Start every worker upfront so that interpreter startup and imports happen in parallel
+        # before the first package is dispatched
+        for _ in range(size):
+            worker = GeneratorWorker(generator, env, pass_fds)
+            worker.start()
+            self.workers.append(worker)
+            self.idle.put(worker)
+
+    def run(self, js, mode=None):
+        worker = self.idle.get()
+        try:
+            return worker.run(js, mode)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()